@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple, Union
+
+from conllu_path_shartular import Search, iter_sentences_from_conllu
+from conllu_path_shartular.conllu import conllu_to_node, iter_sentences_from_lines
+from conllu_path_shartular.sentence import Sentence
+
+from treebank import write_treebank
+
+# Offline benchmarks of parsing, tree building, traversal and search over a synthetic treebank.
+# Run from a checkout with: PYTHONPATH=src python benchmarks/run.py [--json results.json]
+# Every benchmark is timed as the best of --repeat runs, then run once more under tracemalloc
+# for its peak memory.
+
+# one query per path marker, plus compound tests
+QUERIES = {
+    '/': './/[upos=VERB]/[deprel=obj]',
+    '//': '//[upos=NOUN & feats.Case=Gen]',
+    './': './/[upos=VERB]./[upos=AUX]',
+    '../': './/[deprel=amod]../[upos=NOUN]',
+    './/': './/[lemma=lemma0]',
+    '.': './/[upos=NOUN].[feats.Number=Plur]',
+    '<': './/[upos=VERB]<[deprel=nsubj]',
+    '>': './/[upos=VERB]>[deprel=obj]',
+    'nested': './/[upos=VERB & /[deprel=obj] & !/[deprel=nsubj]]',
+    'or': './/[deprel=obj | deprel=obl]/[upos=DET]',
+}
+
+Result = Dict[str, Union[float, int, str]]
+
+def measure(name : str, unit : str, setup : Callable[[], object], run : Callable[[object], int],
+            repeat : int) -> Result:
+    # run(setup()) returns the number of units it processed
+    best = None
+    for _ in range(repeat):
+        data = setup()
+        gc.collect()
+        start = time.perf_counter()
+        count = run(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    data = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'name': name, 'unit': unit, 'count': count, 'seconds': best,
+            'per_second': count / best if best else float('inf'), 'peak_mib': peak / (1 << 20)}
+
+def token_lines(lines : List[str]) -> List[str]:
+    return [line for line in lines if line and line[0] != '#']
+
+def sentence_groups(lines : List[str]) -> List[Tuple[List[str], Dict]]:
+    # the token lines and metadata of every sentence, for building sentences from fresh nodes
+    return list(iter_sentences_from_lines(lines, node_factory=lambda line, line_nr: line,
+                                          sentence_factory=lambda rows, **kwargs: (rows, kwargs)))
+
+def run_benchmarks(path : str, repeat : int, queries : Dict[str, str]) -> List[Result]:
+    with open(path, encoding='utf-8') as file:
+        lines = file.read().split('\n')
+    tokens = token_lines(lines)
+    groups = sentence_groups(lines)
+    sentences = [s for s in iter_sentences_from_conllu(path, use_cache=False) if s]
+    node_count = sum(len(s.sequence) for s in sentences)
+    results = [
+        measure('parse', 'tokens', lambda: tokens,
+                lambda data: sum(1 for line in data if conllu_to_node(line)), repeat),
+        measure('parse eager', 'tokens', lambda: tokens,
+                lambda data: sum(1 for line in data if conllu_to_node(line, lazy=False)), repeat),
+        measure('build tree', 'sentences',
+                lambda: [([conllu_to_node(row) for row in rows], kwargs) for rows, kwargs in groups],
+                lambda data: sum(1 for nodes, kwargs in data if Sentence(nodes, **kwargs)), repeat),
+        measure('read file', 'sentences', lambda: path,
+                lambda data: sum(1 for _ in iter_sentences_from_conllu(data, use_cache=False)), repeat),
+        measure('traverse', 'nodes', lambda: sentences,
+                lambda data: sum(1 for s in data for _ in s.root.traverse()), repeat),
+    ]
+    for marker, expr in queries.items():
+        def run(search : Search) -> int:
+            for s in sentences:
+                search.match(s.root)
+            return len(sentences)
+        result = measure('query %s' % marker, 'sentences', lambda: Search(expr), run, repeat)
+        result['expr'] = expr
+        result['matches'] = sum(len(Search(expr).match(s.root)) for s in sentences)
+        results.append(result)
+    results.append({'name': 'corpus', 'unit': 'nodes', 'count': node_count, 'sentences': len(sentences)})
+    return results
+
+def print_results(results : List[Result]):
+    print('%-14s %14s %12s %10s %10s  %s' % ('benchmark', 'per second', 'unit', 'seconds', 'peak MiB', 'query'))
+    for r in results:
+        if 'seconds' not in r:
+            continue
+        print('%-14s %14.0f %12s %10.3f %10.1f  %s' % (r['name'], r['per_second'], r['unit'], r['seconds'],
+                                                       r['peak_mib'], r.get('expr', '')))
+
+def main(argv : List[str] = None):
+    parser = argparse.ArgumentParser(description='Benchmark conllu_path_shartular on a synthetic treebank')
+    parser.add_argument('-n', '--sentences', type=int, default=5000)
+    parser.add_argument('--min-length', type=int, default=3)
+    parser.add_argument('--max-length', type=int, default=30)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--feature-density', type=float, default=0.4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-q', '--query', nargs='*', default=None, choices=list(QUERIES),
+                        help='path markers of the queries to run (default: all)')
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args(argv)
+    queries = QUERIES if args.query is None else {marker: QUERIES[marker] for marker in args.query}
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_treebank(os.path.join(directory, 'treebank.conllu'), args.sentences,
+                              min_length=args.min_length, max_length=args.max_length, max_depth=args.max_depth,
+                              feature_density=args.feature_density, seed=args.seed)
+        results = run_benchmarks(path, args.repeat, queries)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'python': sys.version, 'arguments': vars(args), 'results': results}, file, indent=1)
+
+if __name__ == '__main__':
+    main()
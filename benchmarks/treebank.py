@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import argparse
+import random
+from typing import List
+
+# Synthetic conllu treebanks for the benchmarks. The same arguments always give the same text.
+
+UPOS = ('NOUN', 'VERB', 'ADJ', 'ADP', 'DET', 'PRON', 'ADV', 'PUNCT', 'AUX', 'CCONJ', 'PROPN', 'NUM')
+DEPREL = ('nsubj', 'obj', 'obl', 'amod', 'det', 'case', 'advmod', 'punct', 'aux', 'conj', 'cc', 'nmod')
+FEATURES = {'Case': ('Nom', 'Acc', 'Dat', 'Gen'), 'Number': ('Sing', 'Plur'), 'Gender': ('Masc', 'Fem', 'Neut'),
+            'Person': ('1', '2', '3'), 'Tense': ('Pres', 'Past', 'Fut'), 'Definite': ('Def', 'Ind'),
+            'Mood': ('Ind', 'Sub', 'Imp'), 'VerbForm': ('Fin', 'Inf', 'Part')}
+LEMMA_COUNT = 2000 # lemmas follow a Zipf-like distribution over this many
+
+def _heads(length : int, max_depth : int, rng : random.Random) -> List[int]:
+    # a random tree over positions 1..length no deeper than max_depth, as conllu heads
+    root = rng.randrange(length)
+    heads = [0] * length
+    depth = {root: 0}
+    attachable = [root]
+    order = [i for i in range(length) if i != root]
+    rng.shuffle(order)
+    for i in order:
+        head = rng.choice(attachable)
+        heads[i] = head + 1
+        depth[i] = depth[head] + 1
+        if depth[i] < max_depth:
+            attachable.append(i)
+    return heads
+
+def _feats(density : float, rng : random.Random) -> str:
+    items = ['%s=%s' % (key, rng.choice(values)) for key, values in FEATURES.items() if rng.random() < density]
+    return '|'.join(items) if items else '_'
+
+def generate_treebank(sentence_count : int, min_length : int = 3, max_length : int = 30, max_depth : int = 6,
+                      feature_density : float = 0.4, seed : int = 0) -> str:
+    # feature_density: the probability of every feature of FEATURES being set on a token
+    rng = random.Random(seed)
+    lemmas = ['lemma%d' % i for i in range(LEMMA_COUNT)]
+    weights = [1.0 / (i + 1) for i in range(LEMMA_COUNT)]
+    lines = []
+    for s in range(sentence_count):
+        length = rng.randint(min_length, max_length)
+        heads = _heads(length, max(max_depth, 1), rng)
+        sentence_lemmas = rng.choices(lemmas, weights, k=length)
+        forms = ['w%d' % rng.randrange(10 * LEMMA_COUNT) for _ in range(length)]
+        if s % 10 == 0:
+            lines.append('# newdoc')
+        lines.append('# sent_id = s%d' % s)
+        lines.append('# text = %s' % ' '.join(forms))
+        if length > 1 and s % 5 == 0: # a multiword token, outside the tree
+            lines.append('1-2\t%s%s\t_\t_\t_\t_\t_\t_\t_\t_' % (forms[0], forms[1]))
+        for i in range(length):
+            deprel = 'root' if heads[i] == 0 else rng.choice(DEPREL)
+            deps = '%d:%s' % (heads[i], deprel) if rng.random() < feature_density else '_'
+            misc = 'SpaceAfter=No' if rng.random() < 0.2 else '_'
+            lines.append('\t'.join([str(i + 1), forms[i], sentence_lemmas[i], rng.choice(UPOS), '_',
+                                    _feats(feature_density, rng), str(heads[i]), deprel, deps, misc]))
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+def write_treebank(path : str, sentence_count : int, **kwargs) -> str:
+    with open(path, 'w', encoding='utf-8', newline='\n') as file:
+        file.write(generate_treebank(sentence_count, **kwargs))
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic conllu treebank')
+    parser.add_argument('path')
+    parser.add_argument('-n', '--sentences', type=int, default=10000)
+    parser.add_argument('--min-length', type=int, default=3)
+    parser.add_argument('--max-length', type=int, default=30)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--feature-density', type=float, default=0.4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_treebank(args.path, args.sentences, min_length=args.min_length, max_length=args.max_length,
+                   max_depth=args.max_depth, feature_density=args.feature_density, seed=args.seed)
@@ -1,5 +1,39 @@
-
 from conllu_path_shartular.tree import Tree
-from conllu_path_shartular.search import Search, Match
-from conllu_path_shartular.conllu import conllu_to_node, iter_sentences_from_conllu, iter_sentences_from_conllu_str
+from conllu_path_shartular.compressed import open_conllu, detect_compression, gzip_conllu
+from conllu_path_shartular.conllu import conllu_to_node, iter_sentences_from_conllu, iter_sentences_from_conllu_str, \
+    ConlluWriter, filter_conllu
 from conllu_path_shartular.exception import ConlluException
+from conllu_path_shartular.sentence_index import SentenceIndex
+from conllu_path_shartular.parsed_cache import ParsedCache, build_parsed_cache
+from conllu_path_shartular.compact import CompactNode, CompactSentence, iter_compact_sentences_from_conllu
+
+# The query machinery (and lark, numpy) is only imported when one of these is first used,
+# so reading and writing conllu does not pay for it.
+_lazy_exports = {
+    'Search': 'search', 'Match': 'search', 'query_cache': 'search',
+    'InvertedIndex': 'inverted_index', 'build_inverted_index': 'inverted_index', 'search_indexed': 'inverted_index',
+    'Corpus': 'corpus', 'search_corpus': 'corpus',
+    'CorpusStatistics': 'query_planner',
+    'ColumnarCorpus': 'columnar',
+    'MultiSearch': 'multi_search',
+    'QueryProfile': 'profiling',
+    'aiter_sentences_from_conllu': 'aio', 'asearch_corpus': 'aio',
+    'ResultCache': 'result_cache',
+    'Rewrite': 'rewrite', 'rewrite_conllu': 'rewrite',
+}
+
+def __getattr__(name : str):
+    if name not in _lazy_exports:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module(__name__ + '.' + _lazy_exports[name]), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_exports))
+
+__all__ = ['Tree', 'open_conllu', 'detect_compression', 'gzip_conllu', 'conllu_to_node', 'iter_sentences_from_conllu',
+           'iter_sentences_from_conllu_str', 'ConlluWriter', 'filter_conllu', 'ConlluException', 'SentenceIndex',
+           'ParsedCache', 'build_parsed_cache', 'CompactNode', 'CompactSentence',
+           'iter_compact_sentences_from_conllu'] + list(_lazy_exports) # star imports load the lazy ones too
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import typing
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from typing import AsyncGenerator, Iterable, List, Tuple
+
+from conllu_path_shartular.conllu import iter_sentences_from_conllu
+from conllu_path_shartular.corpus import Corpus, _search_chunk
+from conllu_path_shartular.search import Search, Match
+from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree
+
+ASYNC_BATCH_SIZE = 256 # sentences parsed per executor call
+ASYNC_CHUNK_SIZE = 1 << 20 # bytes of conllu text per search task; smaller than Corpus.search's, for earlier results
+
+def _take(iterator : typing.Iterator, n : int) -> List:
+    return list(islice(iterator, n))
+
+async def aiter_sentences_from_conllu(file : typing.TextIO | str, backend : str = 'text',
+                                      batch_size : int = ASYNC_BATCH_SIZE, executor : Executor = None) \
+        -> AsyncGenerator[Sentence, None]:
+    # Like iter_sentences_from_conllu, parsing in a thread so the event loop keeps running. Sentences
+    # are parsed batch_size at a time, one batch ahead of the consumer; executor defaults to a
+    # single thread of its own. Closing or cancelling the consumer stops reading after the current batch.
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=1)
+    sentences = iter_sentences_from_conllu(file, backend)
+    future = executor.submit(_take, sentences, batch_size)
+    try:
+        while True:
+            batch = await asyncio.wrap_future(future)
+            if not batch:
+                return
+            future = executor.submit(_take, sentences, batch_size) # read ahead while the consumer works
+            for sentence in batch:
+                yield sentence
+    finally:
+        # the generator may still be running in the executor; it can only be closed once it stops
+        future.cancel()
+        future.add_done_callback(lambda _: sentences.close())
+        if own_executor:
+            executor.shutdown(wait=False)
+
+async def asearch_corpus(path_or_paths : str|Iterable[str], expr : str|Search, executor : Executor = None,
+                         ordered : bool = True, chunk_size : int = ASYNC_CHUNK_SIZE, max_pending : int = None) \
+        -> AsyncGenerator[Tuple[str, List[Match]|List[Tree]], None]:
+    # Like Corpus.search: yields (sent_id, matches) as the chunks of the corpus are searched in
+    # executor, by default a process pool of its own. At most max_pending chunks (default: twice
+    # the workers) are searched ahead of the consumer. Closing or cancelling the consumer cancels
+    # the chunks not yet started; those already running finish and are dropped.
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+    if max_pending is None:
+        max_pending = 2 * (getattr(executor, '_max_workers', None) or 1)
+    search_chunk = partial(_search_chunk, expr=expr)
+    pending : typing.Deque[asyncio.Future] = deque()
+    chunks = Corpus(path_or_paths).chunks(chunk_size)
+    try:
+        async def submit(n : int):
+            while n > 0:
+                # chunks are read in a thread; for compressed files that means decompressing them
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    return
+                pending.append(asyncio.wrap_future(executor.submit(search_chunk, chunk)))
+                n -= 1
+        await submit(max_pending)
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+                await done[0]
+            else:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                results = future.result()
+                await submit(1)
+                for result in results:
+                    yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        try:
+            chunks.close()
+        except ValueError: # still reading in its thread, after a cancellation; closed once collected
+            pass
+        if own_executor:
+            executor.shutdown(wait=False)
@@ -0,0 +1,249 @@
+from __future__ import annotations
+
+import typing
+from array import array
+from collections import defaultdict
+from typing import Dict, List, Generator, Tuple
+
+try:
+    import numpy as np
+except ImportError: # optional dependency, see ColumnarCorpus
+    np = None
+
+from conllu_path_shartular.conllu import conllu_fields, field_is_dict, iter_sentences_from_conllu
+from conllu_path_shartular.search import Search, Match
+from conllu_path_shartular.search_evaluator import Evaluator, ValueComparer, ConstantEvaluator, \
+    NodePathEvaluator, Operation, Operator
+from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree
+
+NO_VALUE = -1 # code of a missing value; indexes the trailing False of every match table
+
+class _Column:
+    # integer-coded values of one field for every token
+    def __init__(self, token_count : int):
+        self.vocab : List[str] = []
+        self._codes : Dict[str, int] = {}
+        self.codes = np.full(token_count, NO_VALUE, dtype=np.int32)
+    def set(self, token : int, value : str):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.vocab)
+            self.vocab.append(value)
+        self.codes[token] = code
+    def mask(self, values : typing.Set[str]) -> np.ndarray:
+        table = np.zeros(len(self.vocab) + 1, dtype=bool)
+        table[[self._codes[v] for v in values if v in self._codes]] = True
+        return table[self.codes]
+
+class _SparseColumn:
+    # integer-coded value sets of one key of a dict field, only for the tokens having it
+    def __init__(self, token_count : int):
+        self.token_count = token_count
+        self.vocab : List[frozenset] = []
+        self._codes : Dict[frozenset, int] = {}
+        self._codes_by_value : Dict[str, List[int]] = defaultdict(list) # codes of the sets containing a value
+        self._tokens = array('q')
+        self._token_codes = array('i')
+        self.tokens = self.codes = None # numpy views of the above, once finished
+    def set(self, token : int, value : frozenset):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.vocab)
+            self.vocab.append(value)
+            for v in value:
+                self._codes_by_value[v].append(code)
+        self._tokens.append(token)
+        self._token_codes.append(code)
+    def finish(self):
+        self.tokens = np.frombuffer(self._tokens, dtype=np.int64) if self._tokens else np.zeros(0, dtype=np.int64)
+        self.codes = np.frombuffer(self._token_codes, dtype=np.int32) if self._token_codes else np.zeros(0, dtype=np.int32)
+    def mask(self, values : typing.Set[str]) -> np.ndarray:
+        result = np.zeros(self.token_count, dtype=bool)
+        codes = [code for v in values for code in self._codes_by_value.get(v, ())]
+        if codes:
+            table = np.zeros(len(self.vocab), dtype=bool)
+            table[codes] = True
+            result[self.tokens[table[self.codes]]] = True
+        return result
+
+class ColumnarCorpus:
+    # Token-level arrays for a whole corpus: integer-coded fields, head indices and sentence
+    # boundaries. Keys of feats and misc are stored only for the tokens having them. Queries are
+    # evaluated as boolean masks over all tokens at once; path steps become array operations
+    # along the head links. Requires numpy.
+    def __init__(self, sentences : List[Sentence], keep_sentences : bool = True):
+        if np is None:
+            raise ImportError('ColumnarCorpus requires numpy')
+        token_count = sum(len(s.sequence) for s in sentences)
+        self.sentence_count = len(sentences)
+        self.token_count = token_count
+        self.sent_ids = [s.sent_id for s in sentences]
+        self.sentences = sentences if keep_sentences else None
+        self.sentence_start = np.zeros(len(sentences) + 1, dtype=np.int64)
+        self.columns : Dict[str, _Column|_SparseColumn] = {label: _Column(token_count) for label in conllu_fields
+                                             if label not in field_is_dict}
+        self.head = np.full(token_count, -1, dtype=np.int64)
+        self.id_nr = np.full(token_count, -1, dtype=np.int64)
+        self.is_root = np.zeros(token_count, dtype=bool)
+        token = 0
+        for s, sentence in enumerate(sentences):
+            start = token
+            positions = {n.id(): start + i for i, n in enumerate(sentence.sequence)}
+            for node in sentence.sequence:
+                self._add_token(token, node)
+                id_nr = node.id_nr()
+                if sentence and id_nr is not None:
+                    self.id_nr[token] = id_nr
+                    head = node.sdata('head')
+                    if head == '0':
+                        self.is_root[token] = True
+                    elif head in positions:
+                        self.head[token] = positions[head]
+                token += 1
+            self.sentence_start[s + 1] = token
+        for column in self.columns.values():
+            if isinstance(column, _SparseColumn):
+                column.finish()
+        self.has_head = self.head >= 0
+        self._head = np.where(self.has_head, self.head, 0) # safe to index with
+        self.sentence_of_token = np.repeat(np.arange(len(sentences)), np.diff(self.sentence_start))
+
+    @staticmethod
+    def from_conllu(file : typing.TextIO | str, keep_sentences : bool = True, backend : str = 'text') \
+            -> ColumnarCorpus:
+        return ColumnarCorpus(list(iter_sentences_from_conllu(file, backend)), keep_sentences)
+
+    def _add_token(self, token : int, node : Tree):
+        for label in conllu_fields:
+            value = node.data(label)
+            if value is None:
+                continue
+            if isinstance(value, str):
+                self.columns[label].set(token, value)
+            elif isinstance(value, Tree) and label != 'deps': # deps keys are head ids, which queries cannot name
+                for sub_key in value.keys():
+                    sub_value = value.data(sub_key)
+                    if sub_value is None or isinstance(sub_value, Tree):
+                        continue
+                    key = label + Tree.PATH_SEPARATOR + sub_key
+                    if key not in self.columns:
+                        self.columns[key] = _SparseColumn(self.token_count)
+                    sub_value = frozenset([sub_value] if isinstance(sub_value, str) else sub_value)
+                    self.columns[key].set(token, sub_value)
+
+    def __len__(self):
+        return self.sentence_count
+
+    def mask(self, evaluator : Evaluator) -> np.ndarray:
+        # tokens for which the evaluator is true
+        if isinstance(evaluator, ConstantEvaluator):
+            return np.full(self.token_count, evaluator.evaluate(None), dtype=bool)
+        if isinstance(evaluator, ValueComparer):
+            column = self.columns.get(Tree.PATH_SEPARATOR.join(evaluator.key))
+            if column is None: # unknown field, or a whole dict field, which never equals a value
+                return np.zeros(self.token_count, dtype=bool)
+            return column.mask(evaluator.values)
+        if isinstance(evaluator, Operation):
+            left = self.mask(evaluator.left)
+            if evaluator.operator == Operator.NOT:
+                return ~left
+            if evaluator.operator == Operator.AND:
+                return left & self.mask(evaluator.right)
+            if evaluator.operator == Operator.OR:
+                return left | self.mask(evaluator.right)
+        if isinstance(evaluator, NodePathEvaluator):
+            return self._exists(evaluator.path_type, self.mask(evaluator.evaluator))
+        raise ValueError('Cannot vectorize evaluator ' + str(evaluator))
+
+    def _parents_of(self, nodes : np.ndarray) -> np.ndarray:
+        parents = np.zeros(self.token_count, dtype=bool)
+        parents[self.head[nodes & self.has_head]] = True
+        return parents
+    def _children_of(self, nodes : np.ndarray) -> np.ndarray:
+        return self.has_head & nodes[self._head]
+    def _closure(self, nodes : np.ndarray, step : typing.Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        # repeats step until no new nodes are reached, one tree level per iteration
+        result = np.zeros(self.token_count, dtype=bool)
+        current = nodes
+        while True:
+            new = step(current) & ~result
+            if not new.any():
+                return result
+            result |= new
+            current = new
+
+    def _exists(self, path_type : str, nodes : np.ndarray) -> np.ndarray:
+        # tokens having at least one of nodes along path_type
+        if path_type == '.':
+            return nodes
+        if path_type == '/':
+            return self._parents_of(nodes)
+        if path_type == './':
+            return nodes | self._parents_of(nodes)
+        if path_type == '//':
+            return self._closure(nodes, self._parents_of)
+        if path_type == './/':
+            return nodes | self._closure(nodes, self._parents_of)
+        if path_type in ('<', '>'):
+            head_id_nr = self.id_nr[self._head]
+            side = self.id_nr < head_id_nr if path_type == '<' else self.id_nr > head_id_nr
+            return self._parents_of(nodes & side)
+        if path_type == '../':
+            return self._children_of(nodes)
+        raise Exception("Unknown path " + str(path_type))
+
+    def _reach(self, path_type : str, nodes : np.ndarray) -> np.ndarray:
+        # tokens found along path_type starting from any of nodes
+        if path_type == '.':
+            return nodes
+        if path_type == '/':
+            return self._children_of(nodes)
+        if path_type == './':
+            return nodes | self._children_of(nodes)
+        if path_type == '//':
+            return self._closure(nodes, self._children_of)
+        if path_type == './/':
+            return nodes | self._closure(nodes, self._children_of)
+        if path_type in ('<', '>'):
+            head_id_nr = self.id_nr[self._head]
+            side = self.id_nr < head_id_nr if path_type == '<' else self.id_nr > head_id_nr
+            return self._children_of(nodes) & side
+        if path_type == '../':
+            return self._parents_of(nodes)
+        raise Exception("Unknown path " + str(path_type))
+
+    def level_masks(self, expr : str|Search) -> List[np.ndarray]:
+        # for each step of the query, the tokens that are part of a complete match at that level
+        search = Search(expr) if isinstance(expr, str) else expr
+        steps = search.evaluator_sequence
+        masks = []
+        current = self.is_root
+        for step in steps:
+            current = self._reach(step.path_type, current) & self.mask(step.evaluator)
+            masks.append(current)
+        for i in range(len(steps) - 2, -1, -1): # drop nodes from which the rest of the path fails
+            masks[i] = masks[i] & self._exists(steps[i + 1].path_type, masks[i + 1])
+        return masks
+
+    def sentence_counts(self, expr : str|Search) -> np.ndarray:
+        # per sentence, the number of top level matches, i.e. len(search.match(sentence.root))
+        masks = self.level_masks(expr)
+        if not masks:
+            return np.zeros(self.sentence_count, dtype=np.int64)
+        return np.bincount(self.sentence_of_token[masks[0]], minlength=self.sentence_count)
+
+    def count(self, expr : str|Search) -> int:
+        return int(self.sentence_counts(expr).sum())
+
+    def matching_sentences(self, expr : str|Search) -> np.ndarray:
+        return np.flatnonzero(self.sentence_counts(expr))
+
+    def search(self, expr : str|Search) -> Generator[Tuple[str, List[Match]|List[Tree]], None, None]:
+        # like Corpus.search, but only walks the trees of the sentences known to match;
+        # self.sentences[i] is the sentence of self.sent_ids[i]
+        if self.sentences is None:
+            raise Exception('ColumnarCorpus was built without keeping its sentences')
+        search = Search(expr) if isinstance(expr, str) else expr
+        for s in self.matching_sentences(search):
+            yield self.sent_ids[s], search.match(self.sentences[s].root)
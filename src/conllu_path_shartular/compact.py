@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import sys
+import typing
+from array import array
+from functools import lru_cache
+from typing import Dict, List, Set, FrozenSet, Generator
+
+from conllu_path_shartular.conllu import conllu_fields, conllu_index_dict, field_is_dict, EMPTY_FIELD, \
+    format_dict_field, split_dict_field, node_to_conllu, iter_conllu_lines, iter_sentences_from_lines
+from conllu_path_shartular.exception import ConlluException
+from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree, DictNode, TreeOrder
+
+# closed-vocabulary columns, whose strings are interned so that all tokens share them
+interned_fields = ('id', 'upos', 'xpos', 'feats', 'head', 'deprel', 'deps')
+_interned_indices = frozenset(conllu_index_dict[label] for label in interned_fields)
+_dict_indices = {conllu_index_dict[label]: label for label in field_is_dict}
+_ID, _HEAD = conllu_index_dict['id'], conllu_index_dict['head']
+NO_NODE = -1
+
+@lru_cache(maxsize=1 << 16)
+def _parse_dict_field(label : str, raw : str) -> Dict[str, FrozenSet[str]]:
+    # parsed dict fields are shared by every token with the same raw value, so they are never mutated
+    return {sys.intern(k): frozenset(sys.intern(v) for v in values)
+            for k, values in split_dict_field(label, raw).to_dict().items()}
+
+def _split_row(source : str, line_nr : int = None) -> List[str|None]:
+    data_fields = source.strip().split('\t')
+    if len(data_fields) != len(conllu_fields):
+        raise ConlluException(source, 'Invalid nr of fields', line_nr)
+    return [None if not data_str or data_str == EMPTY_FIELD else
+            (sys.intern(data_str) if i in _interned_indices else data_str)
+            for i, data_str in enumerate(data_fields)]
+
+class CompactNode(Tree):
+    # A token of a CompactSentence. Field values live in the sentence's columns and the tree
+    # structure in its integer arrays; the node itself only holds its position.
+    # Dict fields are returned as fresh DictNodes (and their values as frozensets), so they
+    # can only be changed through assign.
+    __slots__ = ('_sentence', '_i', '_order', '_order_pos')
+    def __init__(self, sentence : CompactSentence, i : int):
+        self._sentence = sentence
+        self._i = i
+        self._order = None
+        self._order_pos = None
+
+    @property
+    def parent(self) -> Tree|None:
+        head = self._sentence._heads[self._i]
+        return self._sentence.sequence[head] if head != NO_NODE else None
+    def set_children(self, children : List[Tree]):
+        raise Exception('The tree of a CompactSentence is built by CompactSentence.build_tree')
+    def _child_positions(self, start : int = 0, end : int = None) -> array:
+        sentence = self._sentence
+        first, last = sentence._child_start[self._i], sentence._child_start[self._i + 1]
+        return sentence._child_index[first + start : last if end is None else first + end]
+    def children(self) -> List[Tree]:
+        sequence = self._sentence.sequence
+        return [sequence[j] for j in self._child_positions()]
+    def before(self) -> List[Tree]:
+        sequence = self._sentence.sequence
+        return [sequence[j] for j in self._child_positions(0, self._sentence._before_count[self._i])]
+    def after(self) -> List[Tree]:
+        sequence = self._sentence.sequence
+        return [sequence[j] for j in self._child_positions(self._sentence._before_count[self._i])]
+
+    def keys(self) -> List[str]:
+        return list(conllu_fields)
+    def raw_line(self) -> str:
+        # the columns hold every field as its conllu string, so the line is always current
+        return '\t'.join([EMPTY_FIELD if column[self._i] is None else column[self._i]
+                          for column in self._sentence._columns])
+    def to_dict(self) -> Dict:
+        values = {label: self.data(label) for label in conllu_fields}
+        return {k: (v.to_dict() if isinstance(v, Tree) else v) for k, v in values.items()}
+    def data(self, path: str | List[str] = None) -> Tree | Set | str | None:
+        if isinstance(path, str):
+            path = path.split(Tree.PATH_SEPARATOR)
+        if not path:
+            return self
+        i = conllu_index_dict.get(path[0])
+        if i is None:
+            return None
+        v = self._sentence._columns[i][self._i]
+        if v is None:
+            return None
+        if i in _dict_indices:
+            d = _parse_dict_field(_dict_indices[i], v)
+            if len(path) == 1:
+                return DictNode({k: set(values) for k, values in d.items()})
+            return d.get(path[1]) if len(path) == 2 else None
+        return v if len(path) == 1 else None
+
+    def assign(self, path: str | List[str], value: Tree | Set | str) -> bool:
+        if isinstance(path, str):
+            path = path.split(Tree.PATH_SEPARATOR)
+        i = conllu_index_dict.get(path[0])
+        if i is None:
+            return False
+        column = self._sentence._columns[i]
+        if len(path) == 1:
+            if isinstance(value, Tree):
+                value = value.to_dict()
+            if isinstance(value, dict):
+                if i not in _dict_indices:
+                    return False
+                value = format_dict_field(_dict_indices[i], value) if value else None
+            elif value is not None and not isinstance(value, str):
+                return False
+            column[self._i] = sys.intern(value) if value and i in _interned_indices else value
+            return True
+        if i not in _dict_indices or column[self._i] is None:
+            return False
+        if len(path) == 2:
+            label = _dict_indices[i]
+            d = dict(_parse_dict_field(label, column[self._i]))
+            if path[1] in d: # like DictNode.assign, only existing keys are replaced
+                d[path[1]] = {value} if isinstance(value, str) else value
+                column[self._i] = sys.intern(format_dict_field(label, d))
+        return True
+
+class CompactSentence(Sentence):
+    # a sentence stored column-wise, with head and children given as positions in integer arrays
+    def __init__(self, rows : List[List[str|None]], **kwargs):
+        n = len(rows)
+        self._columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in conllu_fields]
+        self._heads = array('i', [NO_NODE]) * n
+        self._before_count = array('i', [0]) * n
+        self._child_start = array('i', [0]) * (n + 1)
+        self._child_index = array('i')
+        super().__init__([CompactNode(self, i) for i in range(n)], **kwargs)
+
+    def build_tree(self):
+        ids, heads = self._columns[_ID], self._columns[_HEAD]
+        positions = {id: i for i, id in enumerate(ids) if id is not None and id.isnumeric()}
+        children = [[] for _ in ids]
+        for i, id in enumerate(ids):
+            if id not in positions:
+                continue
+            if heads[i] == '0':
+                self.root = self.sequence[i]
+            else:
+                head = positions[heads[i]]
+                self._heads[i] = head
+                children[head].append(i)
+        for i, child_positions in enumerate(children):
+            child_positions.sort(key=lambda j: int(ids[j]))
+            if ids[i] in positions:
+                self._before_count[i] = sum(1 for j in child_positions if int(ids[j]) < int(ids[i]))
+            self._child_index.extend(child_positions)
+            self._child_start[i + 1] = len(self._child_index)
+        if self.root is not None:
+            TreeOrder(self.root)
+
+def compact_sentence(sentence : Sentence) -> CompactSentence:
+    rows = [_split_row(node_to_conllu(node)) for node in sentence.sequence]
+    return CompactSentence(rows, sent_id=sentence.sent_id, text=sentence.text, meta=sentence.meta)
+
+def iter_compact_sentences_from_conllu(file : typing.TextIO | str, backend : str = 'text') \
+        -> Generator[CompactSentence, None, None]:
+    return iter_sentences_from_lines(iter_conllu_lines(file, backend), _split_row, CompactSentence)
@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+import typing
+import zlib
+from array import array
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Tuple
+
+try:
+    import zstandard
+except ImportError: # optional dependency, only needed for .zst files
+    zstandard = None
+
+COMPRESSION_MAGIC = ((b'\x1f\x8b', 'gzip'), (b'\xfd7zXZ\x00', 'xz'), (b'BZh', 'bz2'), (b'\x28\xb5\x2f\xfd', 'zstd'))
+READ_AHEAD_CHUNK_SIZE = 1 << 20 # decompressed bytes per read of the background thread
+READ_AHEAD_DEPTH = 4 # chunks decompressed ahead of the reader
+GZIP_MEMBER_SIZE = 1 << 16 # uncompressed bytes per member written by gzip_conllu
+GZIP_PROBE_SIZE = 1 << 24 # decompressed bytes of a first gzip member beyond which seeks_by_member gives up
+
+def detect_compression(path : str) -> str|None:
+    # 'gzip', 'xz', 'bz2' or 'zstd', from the first bytes of the file; None if not compressed
+    with open(path, 'rb') as file:
+        head = file.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+def _open_decompressed(path : str, compression : str) -> typing.BinaryIO:
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'xz':
+        return lzma.open(path, 'rb')
+    if compression == 'bz2':
+        return bz2.open(path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('Reading zstd files requires zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    raise ValueError('Unknown compression ' + str(compression))
+
+def open_conllu(path : str, seekable : bool = False, threaded : bool = True) -> typing.BinaryIO:
+    # Binary stream of the conllu text in path, decompressed if the file is compressed.
+    # seekable: offsets are positions in the decompressed text. Multi-member gzip files seek by
+    # member, xz and bz2 files by decompressing again from the start; zstd files cannot seek.
+    # threaded: decompress in a background thread, ahead of the reader (not with seekable).
+    compression = detect_compression(path)
+    if compression is None:
+        return open(path, 'rb')
+    if seekable:
+        if compression == 'gzip':
+            return io.BufferedReader(SeekableGzipReader(path), READ_AHEAD_CHUNK_SIZE)
+        if compression == 'zstd':
+            raise Exception('Random access is not supported in zstd files: ' + path)
+        return _open_decompressed(path, compression)
+    stream = _open_decompressed(path, compression)
+    return io.BufferedReader(ThreadedReader(stream), READ_AHEAD_CHUNK_SIZE) if threaded else stream
+
+def seeks_by_member(path : str) -> bool:
+    # Whether open_conllu(path, seekable=True) seeks without decompressing from the start: true for
+    # plain files and gzip files of several members, judged by whether the first member ends early.
+    compression = detect_compression(path)
+    if compression != 'gzip':
+        return compression is None
+    decompressor = zlib.decompressobj(31)
+    decompressed = 0
+    with open(path, 'rb') as file:
+        while decompressed <= GZIP_PROBE_SIZE:
+            data = decompressor.unconsumed_tail or file.read(READ_AHEAD_CHUNK_SIZE)
+            if not data: # truncated
+                return False
+            decompressed += len(decompressor.decompress(data, READ_AHEAD_CHUNK_SIZE))
+            if decompressor.eof:
+                rest = decompressor.unused_data + file.read(READ_AHEAD_CHUNK_SIZE)
+                return bool(rest.strip(b'\0')) # more than padding after the first member
+    return False
+
+class ThreadedReader(io.RawIOBase):
+    # Reads a stream ahead in a background thread. zlib, lzma and bz2 release the GIL while
+    # decompressing, so decompression overlaps with parsing what was already read.
+    def __init__(self, source : typing.BinaryIO, chunk_size : int = READ_AHEAD_CHUNK_SIZE,
+                 depth : int = READ_AHEAD_DEPTH):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(depth)
+        self._closing = threading.Event()
+        self._pending = memoryview(b'')
+        self._position = 0
+        self._done = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._closing.is_set():
+                data = self._source.read(self._chunk_size)
+                self._put(data)
+                if not data: # end of stream
+                    return
+        except BaseException as e: # raised again in the reading thread
+            self._put(e)
+
+    def _put(self, item : bytes|BaseException):
+        while not self._closing.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        if not self._pending:
+            if self._done:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, BaseException):
+                self._done = True
+                raise item
+            if not item:
+                self._done = True
+                return 0
+            self._pending = memoryview(item)
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self._position += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._closing.set()
+            self._thread.join()
+            self._source.close()
+        super().close()
+
+def gzip_members(path : str) -> Tuple[array, array]:
+    # compressed and decompressed start offsets of every member of a gzip file
+    compressed, decompressed = array('q'), array('q')
+    with open(path, 'rb') as file:
+        base, total = 0, 0 # compressed offset of data, decompressed bytes so far
+        decompressor = None
+        data = file.read(READ_AHEAD_CHUNK_SIZE)
+        while data:
+            if decompressor is None:
+                if not data.strip(b'\0'): # padding after the last member
+                    break
+                compressed.append(base)
+                decompressor = zlib.decompressobj(31)
+                decompressed.append(total)
+            total += len(decompressor.decompress(data))
+            if decompressor.eof:
+                base += len(data) - len(decompressor.unused_data)
+                data = decompressor.unused_data or file.read(READ_AHEAD_CHUNK_SIZE)
+                decompressor = None
+            else:
+                base += len(data)
+                data = file.read(READ_AHEAD_CHUNK_SIZE)
+        if decompressor is not None:
+            raise Exception('Truncated gzip file: ' + path)
+    decompressed.append(total) # end of the last member
+    return compressed, decompressed
+
+@lru_cache(maxsize=64)
+def _cached_gzip_members(path : str, size : int, mtime_ns : int) -> Tuple[array, array]:
+    return gzip_members(path)
+
+class SeekableGzipReader(io.RawIOBase):
+    # Decompressed view of a gzip file with random access. Every gzip member is an independent
+    # stream, so a seek starts decompressing at the member holding the target offset; files
+    # made of many small members (see gzip_conllu) seek in near-constant time.
+    def __init__(self, path : str):
+        stat = os.stat(path)
+        self._compressed, self._decompressed = _cached_gzip_members(path, stat.st_size, stat.st_mtime_ns)
+        self._file = open(path, 'rb')
+        self._pending = memoryview(b'')
+        self._start_member(0)
+
+    def _start_member(self, member : int):
+        self._member = member
+        self._pending = memoryview(b'')
+        if member >= len(self._compressed):
+            self._decompressor = None
+            self._position = self._decompressed[-1]
+            return
+        self._file.seek(self._compressed[member])
+        self._decompressor = zlib.decompressobj(31)
+        self._position = self._decompressed[member]
+
+    def readable(self) -> bool:
+        return True
+    def seekable(self) -> bool:
+        return True
+    def tell(self) -> int:
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            decompressor = self._decompressor
+            if decompressor is None:
+                return 0
+            if decompressor.eof:
+                self._start_member(self._member + 1)
+                continue
+            data = decompressor.unconsumed_tail or self._file.read(READ_AHEAD_CHUNK_SIZE)
+            if not data:
+                raise Exception('Truncated gzip file: ' + self._file.name)
+            self._pending = memoryview(decompressor.decompress(data, READ_AHEAD_CHUNK_SIZE))
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self._position += n
+        return n
+
+    def seek(self, offset : int, whence : int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._decompressed[-1]
+        member = max(bisect_right(self._decompressed, offset, 0, len(self._compressed)) - 1, 0)
+        if member != self._member or offset < self._position:
+            self._start_member(member)
+        skip = bytearray(min(READ_AHEAD_CHUNK_SIZE, max(offset - self._position, 0)))
+        while self._position < offset:
+            if not self.readinto(memoryview(skip)[:offset - self._position]):
+                break
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+def gzip_conllu(source : str, destination : str, member_size : int = GZIP_MEMBER_SIZE,
+                compresslevel : int = 6) -> int:
+    # Compresses a (possibly compressed) conllu file as a gzip file of members of about member_size
+    # bytes, each ending after a blank line, for fast random access. Returns the number of members.
+    members = 0
+    with open_conllu(source) as file, open(destination, 'wb') as output:
+        lines, size = [], 0
+        for line in file:
+            lines.append(line)
+            size += len(line)
+            if size >= member_size and not line.strip():
+                output.write(gzip.compress(b''.join(lines), compresslevel))
+                members += 1
+                lines, size = [], 0
+        if lines:
+            output.write(gzip.compress(b''.join(lines), compresslevel))
+            members += 1
+    return members
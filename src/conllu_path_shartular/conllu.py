@@ -1,11 +1,19 @@
 from __future__ import annotations
 
+import io
+import mmap
+import os
 import typing
+from functools import partial
 from io import StringIO
-from typing import Dict, List, Generator
+from typing import Dict, List, Generator, Tuple
+from conllu_path_shartular.compressed import detect_compression, open_conllu
 from conllu_path_shartular.exception import ConlluException
-from conllu_path_shartular.tree import Tree, FixedKeysNode, DictNode
-from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree, FixedKeysNode, DictNode, LazyField
+from conllu_path_shartular.sentence import Sentence, ROOT_HEAD, NO_HEAD
+
+if typing.TYPE_CHECKING:
+    from conllu_path_shartular.search import Search
 
 conllu_fields = ('id', 'form', 'lemma', 'upos', 'xpos', 'feats',
                  'head', 'deprel', 'deps', 'misc')
@@ -17,77 +25,238 @@ KEY_VAL_SEP = {'feats': '=', 'misc' : '=', 'deps': ':'}
 MANY_VALS_SEP = ','
 
 
-def conllu_to_node(source : str, line_nr : int = None) -> FixedKeysNode:
+def split_dict_field(label : str, data_str : str, line_nr : int = None) -> DictNode:
+    items = data_str.split(DICT_ITEM_SPLIT)
+    try:
+        item_dict = {t[0]:set(t[1].split(MANY_VALS_SEP))
+                     for t in (s.split(KEY_VAL_SEP[label], 1) for s in items)}
+    except:
+        raise ConlluException(data_str, 'Error splitting dict field', line_nr)
+    return DictNode(item_dict)
+
+_dict_field_indices = [(conllu_index_dict[label], label) for label in field_is_dict]
+_dict_field_parsers = {label: partial(split_dict_field, label) for label in field_is_dict}
+
+def conllu_to_node(source : str, line_nr : int = None, lazy : bool = True) -> FixedKeysNode:
+    # lazy: keep dict fields (feats, misc, deps) as raw strings until first read;
+    # a malformed dict field is then only reported when it is read
     data_fields = source.strip().split('\t')
     if len(data_fields) != len(conllu_fields):
         raise ConlluException(source, 'Invalid nr of fields', line_nr)
-    data_list = []
-    for label, data_str in zip(conllu_fields, data_fields):
-        if not data_str or data_str == EMPTY_FIELD:
-            data_list.append(None)
-        elif label in field_is_dict:
-            #this field contains a dict
-            items = data_str.split(DICT_ITEM_SPLIT)
-            try:
-                item_dict = {t[0]:set(t[1].split(MANY_VALS_SEP))
-                             for t in (s.split(KEY_VAL_SEP[label], 1) for s in items)}
-            except:
-                raise ConlluException(data_str, 'Error splitting dict field', line_nr)
-            data_list.append(DictNode(item_dict))
-        else:
-            data_list.append(data_str)
-    return FixedKeysNode(data_list, conllu_index_dict)
+    data_list = [None if not data_str or data_str == EMPTY_FIELD else data_str for data_str in data_fields]
+    for i, label in _dict_field_indices:
+        data_str = data_list[i]
+        if data_str is None:
+            continue
+        #this field contains a dict
+        data_list[i] = LazyField(data_str, _dict_field_parsers[label])
+    node = FixedKeysNode(data_list, conllu_index_dict, raw_line=source.strip())
+    if not lazy: # parsed through the node, which then tells changes to the parsed fields from the source
+        for i, label in _dict_field_indices:
+            if data_list[i] is not None:
+                try:
+                    node._value(i)
+                except ConlluException as e:
+                    e.line_nr = line_nr
+                    raise
+    return node
+
+def format_dict_field(label : str, data : Dict) -> str:
+    return DICT_ITEM_SPLIT.join(
+                KEY_VAL_SEP.get(label, '=').join([
+                    k, MANY_VALS_SEP.join(sorted(v)) if not isinstance(v, str) else v
+            ])
+        for k,v in data.items())
+
+def _format_field(label : str, data, node : Tree) -> str:
+    if data.__class__ is str:
+        return data if data else EMPTY_FIELD
+    if data is None:
+        return EMPTY_FIELD
+    if data.__class__ is LazyField: # never parsed, so unchanged
+        return data.raw
+    if isinstance(data, Tree):
+        data = data.to_dict()
+    if isinstance(data, Dict):
+        return format_dict_field(label, data)
+    raise ConlluException(str(data), 'Cannot transform %s item to conllu in %s' % (label, str(node)))
 
 def node_to_conllu(node : Tree) -> str:
-    node = node.to_dict()
-    data_list = []
-    for label in conllu_fields:
-        data = node.get(label)
-        if isinstance(data, str):
-            data = data if data else EMPTY_FIELD
-        elif data is None:
-            data = EMPTY_FIELD
-        elif isinstance(data, Dict):
-            data =\
-                DICT_ITEM_SPLIT.join(
-                    KEY_VAL_SEP[label].join([
-                        k, MANY_VALS_SEP.join(v) if not isinstance(v, str) else v
-                ])
-            for k,v in data.items())
-        else:
-            raise ConlluException(str(data),
-                    'Cannot transform %s item to conllu in %s' % (label, str(node)))
-        data_list.append(data)
-    return '\t'.join(data_list)
+    line = node.raw_line()
+    if line is not None:
+        return line
+    if isinstance(node, FixedKeysNode) and node.key_index_dict is conllu_index_dict:
+        values = node._dlist # read as stored, without parsing lazy fields
+    else:
+        values = [node.data(label) for label in conllu_fields]
+    return '\t'.join([_format_field(label, data, node) for label, data in zip(conllu_fields, values)])
 
 def sentence_to_conllu(sentence : Sentence) -> str:
-    output = ''.join(['# %s\n' % m for m in sentence.meta]) if sentence.meta else ''
-    output += '# sent_id = %s\n' % str(sentence.sent_id)
-    output += '# text = %s\n' % str(sentence.text)
-    for node in sentence._sequence:
-        output += node_to_conllu(node) + '\n'
-    output += '\n'
-    return output
-
-def iter_sentences_from_conllu(file : typing.TextIO | str) -> Generator[Sentence, None, None]:
+    lines = ['# ' + m for m in sentence.meta] if sentence.meta else []
+    if sentence.sent_id is not None:
+        lines.append('# sent_id = %s' % sentence.sent_id)
+    if sentence.text is not None:
+        lines.append('# text = %s' % sentence.text)
+    lines.extend([node_to_conllu(node) for node in sentence.sequence])
+    lines.append('\n') # blank line ending the sentence
+    return '\n'.join(lines)
+
+WRITE_BUFFER_SIZE = 1 << 16 # characters collected before writing them out
+
+class ConlluWriter:
+    # Writes sentences to a path or text stream in large blocks. Nodes read from conllu and
+    # left unchanged are written as their source line. A path is opened and closed by the
+    # writer; a stream is only flushed.
+    def __init__(self, file : typing.TextIO | str, buffer_size : int = WRITE_BUFFER_SIZE):
+        self._owns_file = isinstance(file, str)
+        self.file = open(file, 'w', encoding='utf-8', newline='\n') if self._owns_file else file
+        self.buffer_size = buffer_size
+        self.sentence_count = 0
+        self._buffer : List[str] = []
+        self._buffered = 0
+
+    def write(self, sentence : Sentence):
+        output = sentence_to_conllu(sentence)
+        self._buffer.append(output)
+        self._buffered += len(output)
+        self.sentence_count += 1
+        if self._buffered >= self.buffer_size:
+            self._write_buffer()
+
+    def write_all(self, sentences : typing.Iterable[Sentence]) -> int:
+        # returns the number of sentences written
+        count = self.sentence_count
+        for sentence in sentences:
+            self.write(sentence)
+        return self.sentence_count - count
+
+    def _write_buffer(self):
+        if self._buffer:
+            self.file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def flush(self):
+        self._write_buffer()
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        if self._owns_file:
+            self.file.close()
+        self.file = None
+
+    def __enter__(self) -> ConlluWriter:
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def filter_conllu(source : typing.TextIO | str, destination : typing.TextIO | str, expr : str|Search,
+                  backend : str = 'text') -> int:
+    # copies the sentences matching expr (a query string or Search), returns how many
+    from conllu_path_shartular.search import query_cache # reading and writing alone need no queries
+    search = query_cache.get(expr) if isinstance(expr, str) else expr
+    with ConlluWriter(destination) as writer:
+        return writer.write_all(sentence for sentence in iter_sentences_from_conllu(source, backend)
+                                if sentence and search.exists(sentence.root))
+
+MMAP_CHUNK_SIZE = 1 << 20 # bytes decoded at a time by the mmap backend
+
+def iter_sentences_from_conllu(file : typing.TextIO | str, backend : str = 'text', use_cache : bool = True) \
+        -> Generator[Sentence, None, None]:
+    # backend 'text' reads decoded lines from a path or text stream; 'mmap' maps the file at path
+    # (or of a binary file), decodes it in large blocks cut at sentence boundaries, and builds the
+    # trees straight from the id and head columns, which makes it about twice as fast.
+    # Compressed files (gzip, xz, bz2, zstd) are detected by their first bytes.
+    # use_cache: read a path from its parsed cache instead, if there is an up to date one
+    if use_cache and isinstance(file, str):
+        from conllu_path_shartular.parsed_cache import iter_cached_sentences # it builds on this module
+        sentences = iter_cached_sentences(file)
+        if sentences is not None:
+            return sentences
+    lines = iter_conllu_lines(file, backend)
+    if backend == 'mmap' and not isinstance(lines, io.TextIOWrapper): # not decompressing
+        return iter_sentences_from_lines(lines, sentence_factory=_sentence_from_columns)
+    return iter_sentences_from_lines(lines)
+
+def iter_conllu_lines(file : typing.TextIO | str, backend : str = 'text') -> typing.Iterable[str]:
+    # a compressed file at path is decompressed in a background thread, whatever the backend
+    if backend not in ('text', 'mmap'):
+        raise ValueError('Unknown backend ' + str(backend))
+    if isinstance(file, str) and detect_compression(file) is not None:
+        return io.TextIOWrapper(open_conllu(file), encoding='utf-8')
+    if backend == 'text':
+        return open(file, 'r', encoding='utf-8') if isinstance(file, str) else file
+    return _iter_mmap_lines(file)
+
+def _iter_mmap_lines(file : typing.BinaryIO | str) -> Generator[str, None, None]:
     if isinstance(file, str):
-        file = open(file, 'r', encoding='utf-8')
+        file = open(file, 'rb')
+    with file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            pos = 0
+            while pos < size:
+                # cut after a line break followed by a blank line, so no sentence is split
+                end = mapped.find(b'\n\n', pos + MMAP_CHUNK_SIZE)
+                if end < 0:
+                    end = mapped.find(b'\n\r\n', pos + MMAP_CHUNK_SIZE)
+                end = size if end < 0 else end + 1
+                lines = mapped[pos:end].decode('utf-8').split('\n')
+                if not lines[-1]: # chunk ended with a line break
+                    lines.pop()
+                yield from lines
+                pos = end
+
+_id_index, _head_index = conllu_index_dict['id'], conllu_index_dict['head']
+
+def _sentence_from_columns(nodes : List[FixedKeysNode], **kwargs) -> Sentence:
+    # Sentence, with the tree built from the id and head columns as read, rather than through the
+    # Tree API. A sentence that is not plainly well formed goes through Sentence's own checks instead.
+    ids = [node._dlist[_id_index] for node in nodes]
+    positions = {}
+    for i, id in enumerate(ids):
+        if id is not None and id.isnumeric():
+            if int(id) != len(positions) + 1:
+                return Sentence(nodes, **kwargs)
+            positions[id] = i
+    heads = []
+    for id, node in zip(ids, nodes):
+        if id not in positions:
+            heads.append(NO_HEAD)
+            continue
+        head = node._dlist[_head_index]
+        if head == '0':
+            heads.append(ROOT_HEAD)
+        elif head in positions:
+            heads.append(positions[head])
+        else:
+            return Sentence(nodes, **kwargs)
+    if heads.count(ROOT_HEAD) != 1 or None in ids or len(set(ids)) != len(ids):
+        return Sentence(nodes, **kwargs)
+    return Sentence(nodes, heads=heads, ids=ids, **kwargs)
+
+def iter_sentences_from_lines(lines : typing.Iterable[str],
+                               node_factory : typing.Callable[[str, int], typing.Any] = conllu_to_node,
+                               sentence_factory : typing.Callable[..., Sentence] = Sentence) \
+        -> Generator[Sentence, None, None]:
     line_nr = 0
     node_sequence = []
     meta_data = []
     special_data = {} # text, sent_id
-    while True:
-        line = file.readline()
+    for line in lines:
         line_nr += 1
-        if not line:
-            break
         line = line.strip()
         if not line:
             # blank line - yield sentence if have sentence
             if node_sequence:
                 if meta_data: # add metadata to sentence **kwargs
                     special_data.update({'meta':meta_data})
-                sentence = Sentence(node_sequence, **(special_data))
+                sentence = sentence_factory(node_sequence, **(special_data))
                 node_sequence = []
                 meta_data = []
                 special_data = {}  # text, sent_id
@@ -103,13 +272,64 @@ def iter_sentences_from_conllu(file : typing.TextIO | str) -> Generator[Sentence
                     continue
             meta_data.append(line.strip())
             continue
-        node_sequence.append(conllu_to_node(line, line_nr))
+        node_sequence.append(node_factory(line, line_nr))
     if node_sequence:
         if meta_data:  # add metadata to sentence **kwargs
             special_data.update({'meta': meta_data})
-        yield Sentence(node_sequence, **(special_data))
-    file.close()
+        yield sentence_factory(node_sequence, **(special_data))
+    if hasattr(lines, 'close'):
+        lines.close()
 
 def iter_sentences_from_conllu_str(conllu_str: str) -> Generator[Sentence, None, None]:
     return iter_sentences_from_conllu(StringIO(conllu_str))
 
+
+def iter_conllu_blocks(file : typing.BinaryIO) -> Generator[Tuple[int, bytes], None, None]:
+    # yields (byte offset, raw bytes) for every sentence, comments included, without parsing it
+    offset = file.tell()
+    start = offset
+    lines = []
+    has_nodes = False
+    for line in file:
+        if not line.strip():
+            if has_nodes:
+                yield start, b''.join(lines)
+                lines = []
+                has_nodes = False
+            if not lines:
+                start = offset + len(line)
+        else:
+            lines.append(line)
+            has_nodes = has_nodes or not line.startswith(b'#')
+        offset += len(line)
+    if has_nodes:
+        yield start, b''.join(lines)
+
+def read_conllu_block(file : typing.BinaryIO, offset : int) -> bytes:
+    # raw bytes of the sentence starting at offset
+    file.seek(offset)
+    for _, block in iter_conllu_blocks(file):
+        return block
+    return b''
+
+def sentence_from_conllu_block(block : bytes) -> Sentence|None:
+    for sentence in iter_sentences_from_conllu_str(block.decode('utf-8')):
+        return sentence
+    return None
+
+def block_sent_id(block : bytes) -> str|None:
+    # the sent_id comment of a raw sentence, if any
+    sent_id = None
+    for line in block.splitlines():
+        line = line.strip()
+        if not line.startswith(b'#') or b'=' not in line:
+            continue
+        k, arg = line[1:].split(b'=', 1)
+        if k.strip() == b'sent_id':
+            sent_id = arg.strip().decode('utf-8')
+    return sent_id
+
+def file_signature(path : str) -> Tuple[int, int]:
+    # size and modification time, used to tell whether files derived from path are out of date
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
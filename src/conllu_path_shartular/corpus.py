@@ -0,0 +1,250 @@
+from __future__ import annotations
+
+import mmap
+import os
+import typing
+from bisect import bisect_right
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from itertools import accumulate
+from typing import List, Tuple, Generator, Iterable, Dict, Optional
+
+from conllu_path_shartular.compressed import detect_compression, open_conllu, seeks_by_member
+from conllu_path_shartular.conllu import iter_sentences_from_conllu, iter_sentences_from_conllu_str, \
+    sentence_from_conllu_block
+from conllu_path_shartular.inverted_index import load_inverted_index
+from conllu_path_shartular.search import Search, Match, GroupKey
+from conllu_path_shartular.sentence_index import SentenceIndex, load_sentence_index
+from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree
+
+DEFAULT_CHUNK_SIZE = 1 << 22 # bytes of conllu text per worker task
+
+# path, start and end offset (in the decompressed text), and for files that cannot seek to the start,
+# the chunk's bytes, read in the main process
+Chunk = Tuple[str, int, int, Optional[bytes]]
+
+def split_conllu_chunks(path : str, chunk_size : int = DEFAULT_CHUNK_SIZE) -> Generator[Chunk, None, None]:
+    # byte ranges of roughly chunk_size, each ending right after a blank line. Compressed files are
+    # read through once; their chunks carry their text, except with multi-member gzip, which seeks.
+    if not seeks_by_member(path):
+        yield from _read_stream_chunks(path, chunk_size)
+        return
+    if detect_compression(path) is not None:
+        yield from _read_stream_chunks(path, chunk_size, keep=False)
+        return
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        start = 0
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                file.seek(end)
+                file.readline() # skip to the start of the next line
+                while True:
+                    line = file.readline()
+                    if not line:
+                        end = size
+                        break
+                    if not line.strip():
+                        end = file.tell()
+                        break
+            yield path, start, end, None
+            start = end
+
+def _read_stream_chunks(path : str, chunk_size : int, keep : bool = True) -> Generator[Chunk, None, None]:
+    # like split_conllu_chunks, reading the decompressed text from the start; keep: include it in the chunks
+    with open_conllu(path) as file:
+        start = offset = 0
+        lines = []
+        for line in file:
+            offset += len(line)
+            if keep:
+                lines.append(line)
+            if offset - start >= chunk_size and not line.strip():
+                yield path, start, offset, b''.join(lines) if keep else None
+                start = offset
+                lines = []
+    if offset > start:
+        yield path, start, offset, b''.join(lines) if keep else None
+
+def chunk_bytes(chunk : Chunk) -> bytes:
+    path, start, end, data = chunk
+    if data is not None:
+        return data
+    with open_conllu(path, seekable=True) as file:
+        file.seek(start)
+        return file.read(end - start)
+
+def read_chunk(chunk : Chunk) -> str:
+    return chunk_bytes(chunk).decode('utf-8')
+
+def _search_chunk(chunk : Chunk, expr : str|Search) -> List[Tuple[str, List[Match]|List[Tree]]]:
+    search = Search(expr) if isinstance(expr, str) else expr
+    results = []
+    for sentence in iter_sentences_from_conllu_str(read_chunk(chunk)):
+        if not sentence: # could not build tree
+            continue
+        matches = search.match(sentence.root)
+        if matches:
+            results.append((sentence.sent_id, matches))
+    return results
+
+def _aggregate_chunk(chunk : Chunk, expr : str|Search, key : GroupKey, second_key : GroupKey = None) -> Counter:
+    search = Search(expr) if isinstance(expr, str) else expr
+    return search.aggregate(iter_sentences_from_conllu_str(read_chunk(chunk)), key, second_key)
+
+def _map_chunks(function : typing.Callable[[Chunk], typing.Any], chunks : Iterable[Chunk], workers : int = None,
+                ordered : bool = True) -> Generator[typing.Any, None, None]:
+    # yields function(chunk) for every chunk, computed in a pool of worker processes
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for chunk in chunks:
+            yield function(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = iter(chunks)
+        pending = deque()
+        def submit(n : int):
+            for chunk in chunks:
+                pending.append(executor.submit(function, chunk))
+                n -= 1
+                if n <= 0: break
+        submit(2 * workers) # keep a bounded number of chunks in flight
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                result = future.result()
+                submit(1)
+                yield result
+
+class Corpus:
+    def __init__(self, paths : str|Iterable[str]):
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+        self._indexes : Dict[str, Tuple[SentenceIndex, mmap.mmap|typing.BinaryIO|None]] = {}
+        self._counted : List[SentenceIndex] = [] # the index of every path when _ends was computed
+        self._ends : List[int]|None = None # cumulative sentence counts of the paths
+
+    def sentence_index(self, path : str) -> SentenceIndex:
+        # the sidecar offset index of path, rebuilt when the file changes
+        index, source = self._indexes.get(path, (None, None))
+        if index is None or not index.is_current():
+            if source is not None:
+                source.close()
+            index = load_sentence_index(path)
+            source = None
+            compression = detect_compression(path)
+            if len(index) and compression != 'zstd': # which cannot seek
+                if compression is None:
+                    with open(path, 'rb') as file:
+                        source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    source = open_conllu(path, seekable=True)
+            self._indexes[path] = (index, source)
+        return index
+
+    def _read(self, path : str, i : int) -> Sentence:
+        # expects sentence_index(path) to have just been called
+        index, source = self._indexes[path]
+        offset, length = index.span(i)
+        if source is None:
+            raise ValueError('Random access is not supported in zstd files: ' + path)
+        source.seek(offset)
+        return sentence_from_conllu_block(source.read(length))
+
+    def _sentence_ends(self, check : bool = True) -> List[int]:
+        # the cumulative sentence counts of the paths, recomputed when the index of one was rebuilt
+        # check: first see whether any file changed, rather than trusting the last count
+        if self._ends is None or check:
+            indexes = [self.sentence_index(path) for path in self.paths]
+            if self._ends is None or any(index is not counted for index, counted in zip(indexes, self._counted)):
+                self._counted = indexes
+                self._ends = list(accumulate(len(index) for index in indexes))
+        return self._ends
+
+    def _path_position(self, ends : List[int], i : int) -> Tuple[int, int]:
+        # the position in self.paths of the file of sentence i, and the sentence's position in it
+        if i < 0:
+            i += ends[-1] if ends else 0
+        if i < 0 or not ends or i >= ends[-1]:
+            raise IndexError('sentence index out of range')
+        p = bisect_right(ends, i)
+        return p, i - (ends[p - 1] if p else 0)
+
+    def __len__(self):
+        ends = self._sentence_ends()
+        return ends[-1] if ends else 0
+
+    def __getitem__(self, i : int|slice) -> Sentence|List[Sentence]:
+        # Sentences by position across all files. The sentence counts of the files are kept between
+        # calls: a single position checks only the file it is read from, and if that changed, counts
+        # all files again; a slice, like len(), first checks every file.
+        # Files compressed with zstd cannot seek, so their sentences raise ValueError.
+        if isinstance(i, slice):
+            ends = self._sentence_ends()
+            positions = [self._path_position(ends, j) for j in range(*i.indices(ends[-1] if ends else 0))]
+            return [self._read(self.paths[p], j) for p, j in positions]
+        p, j = self._path_position(self._sentence_ends(check=False), i)
+        if self.sentence_index(self.paths[p]) is not self._counted[p]: # changed since counted
+            p, j = self._path_position(self._sentence_ends(), i)
+        return self._read(self.paths[p], j)
+
+    def get(self, sent_id : str) -> Sentence|None:
+        # the first sentence with sent_id; ValueError if it is in a zstd file, as with __getitem__
+        for path in self.paths:
+            i = self.sentence_index(path).position(sent_id)
+            if i is not None:
+                return self._read(path, i)
+        return None
+
+    def close(self):
+        for _, source in self._indexes.values():
+            if source is not None:
+                source.close()
+        self._indexes = {}
+        self._counted = []
+        self._ends = None
+
+    def __iter__(self) -> Generator[Sentence, None, None]:
+        for path in self.paths:
+            yield from iter_sentences_from_conllu(path)
+
+    def chunks(self, chunk_size : int = DEFAULT_CHUNK_SIZE) -> Generator[Chunk, None, None]:
+        # read lazily, as chunks of compressed files hold their text
+        for path in self.paths:
+            yield from split_conllu_chunks(path, chunk_size)
+
+    def search(self, expr : str|Search, workers : int = None, ordered : bool = True,
+               chunk_size : int = DEFAULT_CHUNK_SIZE, indexed : bool = False) \
+            -> Generator[Tuple[str, List[Match]|List[Tree]], None, None]:
+        # yields (sent_id, matches) for every sentence with at least one match
+        # indexed: prefilter sentences with each file's inverted index, (re)building it if needed
+        if indexed:
+            for path in self.paths:
+                yield from load_inverted_index(path).search(expr)
+            return
+        for results in _map_chunks(partial(_search_chunk, expr=expr), self.chunks(chunk_size), workers, ordered):
+            yield from results
+
+    def aggregate(self, expr : str|Search, key : GroupKey, second_key : GroupKey = None, workers : int = None,
+                  chunk_size : int = DEFAULT_CHUNK_SIZE) -> Counter:
+        # Search.aggregate over the whole corpus; each worker counts its chunks and the counts are merged
+        counts = Counter()
+        for chunk_counts in _map_chunks(partial(_aggregate_chunk, expr=expr, key=key, second_key=second_key),
+                                        self.chunks(chunk_size), workers, ordered=False):
+            counts.update(chunk_counts)
+        return counts
+
+def search_corpus(path_or_paths : str|Iterable[str], expr : str|Search, workers : int = None,
+                  ordered : bool = True, chunk_size : int = DEFAULT_CHUNK_SIZE, indexed : bool = False) \
+        -> Generator[Tuple[str, List[Match]|List[Tree]], None, None]:
+    return Corpus(path_or_paths).search(expr, workers, ordered, chunk_size, indexed)
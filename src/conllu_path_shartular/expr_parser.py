@@ -77,7 +77,15 @@ class ExpressionBuilder(lark.Transformer):
             return [args[0].value]
         return args[0] + [args[1].value]
 
-_parser = lark.Lark(grammar, start="node_list", parser="lalr", transformer=ExpressionBuilder())
+_parser : lark.Lark = None
+
+def get_parser() -> lark.Lark:
+    # built on first use; cache=True keeps the LALR tables in a file in the temp directory,
+    # so later processes load them instead of analysing the grammar again
+    global _parser
+    if _parser is None:
+        _parser = lark.Lark(grammar, start="node_list", parser="lalr", transformer=ExpressionBuilder(), cache=True)
+    return _parser
 
 def parse_evaluator(expr : str) -> List[Evaluator]:
-    return _parser.parse(expr)
+    return get_parser().parse(expr)
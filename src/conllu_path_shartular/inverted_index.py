@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from itertools import product
+from typing import Dict, List, Set, Iterable, Generator, Tuple
+
+from conllu_path_shartular.compressed import open_conllu
+from conllu_path_shartular.conllu import iter_conllu_blocks, read_conllu_block, sentence_from_conllu_block, \
+    conllu_to_node, file_signature
+from conllu_path_shartular.search import Search, Match
+from conllu_path_shartular.search_evaluator import Evaluator, ValueComparer, NodePathEvaluator, Operation, Operator
+from conllu_path_shartular.tree import Tree
+
+INDEX_MAGIC = b'CPTIDX1\n'
+INDEX_EXTENSION = '.tidx'
+DEFAULT_INDEXED_FIELDS = ('form', 'lemma', 'upos', 'xpos', 'feats', 'deprel', 'deps', 'misc')
+MAX_OR_CLAUSES = 16 # beyond this, an OR contributes no constraint
+
+def index_term(key : List[str], value : str) -> str:
+    return Tree.PATH_SEPARATOR.join(key) + '=' + value
+
+def node_terms(node : Tree, fields : Iterable[str]) -> Set[str]:
+    terms = set()
+    for key in fields:
+        value = node.data(key)
+        if isinstance(value, str):
+            terms.add(index_term([key], value))
+        elif isinstance(value, Tree):
+            for sub_key in value.keys():
+                sub_value = value.data(sub_key)
+                sub_value = {sub_value} if isinstance(sub_value, str) else sub_value
+                if not sub_value or isinstance(sub_value, Tree):
+                    continue
+                terms.update(index_term([key, sub_key], v) for v in sub_value)
+    return terms
+
+def block_terms(block : bytes, fields : Iterable[str]) -> Set[str]:
+    # the terms of all nodes of a raw sentence
+    terms = set()
+    for line in block.decode('utf-8').splitlines():
+        line = line.strip()
+        if line and line[0] != '#':
+            terms.update(node_terms(conllu_to_node(line), fields))
+    return terms
+
+class InvertedIndex:
+    # maps field=value terms to the sorted byte offsets of the sentences containing them
+    def __init__(self, index_path : str, header : Dict, postings_offset : int):
+        self.index_path = index_path
+        self.source_path = header['source_path']
+        self.source_signature = tuple(header['source_signature'])
+        self.fields = set(header['fields'])
+        self.sentence_count = header['sentence_count']
+        self._terms : Dict[str, List[int]] = header['terms'] # term -> [position, count]
+        self._postings_offset = postings_offset
+
+    @staticmethod
+    def load(index_path : str) -> InvertedIndex:
+        with open(index_path, 'rb') as file:
+            if file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise Exception('Not an inverted index file: ' + index_path)
+            header_len, = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(header_len).decode('utf-8'))
+        return InvertedIndex(index_path, header, len(INDEX_MAGIC) + 8 + header_len)
+
+    def is_current(self) -> bool:
+        return os.path.exists(self.source_path) and file_signature(self.source_path) == self.source_signature
+
+    def terms(self) -> List[str]:
+        return list(self._terms.keys())
+
+    def postings(self, term : str) -> array:
+        postings = array('q')
+        if term not in self._terms:
+            return postings
+        position, count = self._terms[term]
+        with open(self.index_path, 'rb') as file:
+            file.seek(self._postings_offset + position * postings.itemsize)
+            postings.fromfile(file, count)
+        if sys.byteorder != 'little':
+            postings.byteswap()
+        return postings
+
+    def all_postings(self) -> Dict[str, array]:
+        # the postings of every term, read in one go
+        postings = array('q')
+        with open(self.index_path, 'rb') as file:
+            file.seek(self._postings_offset)
+            postings.fromfile(file, sum(count for _, count in self._terms.values()))
+        if sys.byteorder != 'little':
+            postings.byteswap()
+        return {term: postings[position:position + count] for term, (position, count) in self._terms.items()}
+
+    def frequency(self, term : str) -> int:
+        return self._terms[term][1] if term in self._terms else 0
+
+    def candidates(self, clauses : List[Set[str]]) -> List[int]|None:
+        # offsets of sentences having at least one term of every clause; None if there are no clauses
+        if not clauses:
+            return None
+        clauses = sorted(clauses, key=lambda c: sum(self.frequency(t) for t in c))
+        result = None
+        for clause in clauses:
+            offsets = set()
+            for term in clause:
+                offsets.update(self.postings(term))
+            result = offsets if result is None else result.intersection(offsets)
+            if not result:
+                break
+        return sorted(result)
+
+    def search(self, expr : str|Search) -> Generator[Tuple[str, List[Match]|List[Tree]], None, None]:
+        # like Corpus.search, but only parses the sentences that can match
+        search = Search(expr) if isinstance(expr, str) else expr
+        if not self.is_current():
+            raise Exception('Inverted index %s is out of date for %s' % (self.index_path, self.source_path))
+        offsets = self.candidates(required_terms(search.evaluator_sequence, self.fields))
+        with open_conllu(self.source_path, seekable=offsets is not None) as file:
+            if offsets is None:
+                blocks = iter_conllu_blocks(file)
+            else:
+                blocks = ((offset, read_conllu_block(file, offset)) for offset in offsets)
+            for _, block in blocks:
+                sentence = sentence_from_conllu_block(block)
+                if not sentence:
+                    continue
+                matches = search.match(sentence.root)
+                if matches:
+                    yield sentence.sent_id, matches
+
+def required_terms(evaluator : Evaluator|List[NodePathEvaluator], fields : Iterable[str]) -> List[Set[str]]:
+    # Clauses of index terms a sentence must contain to possibly match: at least one term of each clause.
+    # Only equality tests on indexed fields constrain; negations contribute nothing.
+    if isinstance(evaluator, list): # a Search sequence - every step must match some node
+        return [clause for step in evaluator for clause in required_terms(step, fields)]
+    if isinstance(evaluator, ValueComparer):
+        if evaluator.key[0] not in fields:
+            return []
+        return [{index_term(evaluator.key, v) for v in evaluator.values}]
+    if isinstance(evaluator, NodePathEvaluator):
+        return required_terms(evaluator.evaluator, fields)
+    if isinstance(evaluator, Operation):
+        if evaluator.operator == Operator.AND:
+            return required_terms(evaluator.left, fields) + required_terms(evaluator.right, fields)
+        if evaluator.operator == Operator.OR:
+            left, right = required_terms(evaluator.left, fields), required_terms(evaluator.right, fields)
+            if not left or not right or len(left) * len(right) > MAX_OR_CLAUSES:
+                return []
+            return [l.union(r) for l, r in product(left, right)]
+    return []
+
+def build_inverted_index(conllu_path : str, index_path : str = None,
+                         fields : Iterable[str] = DEFAULT_INDEXED_FIELDS) -> InvertedIndex:
+    index_path = index_path if index_path else conllu_path + INDEX_EXTENSION
+    fields = list(fields)
+    signature = file_signature(conllu_path)
+    term_dict : Dict[str, array] = defaultdict(lambda: array('q'))
+    sentence_count = 0
+    with open_conllu(conllu_path) as file:
+        for offset, block in iter_conllu_blocks(file):
+            sentence_count += 1
+            for term in block_terms(block, fields):
+                term_dict[term].append(offset)
+    return write_inverted_index(index_path, conllu_path, signature, fields, sentence_count, term_dict)
+
+def write_inverted_index(index_path : str, conllu_path : str, signature : Tuple[int, int], fields : List[str],
+                         sentence_count : int, term_dict : Dict[str, array]) -> InvertedIndex:
+    # term_dict: the sorted sentence offsets of every term
+    terms = {}
+    position = 0
+    for term, postings in term_dict.items():
+        terms[term] = [position, len(postings)]
+        position += len(postings)
+    header = json.dumps({'source_path': os.path.abspath(conllu_path), 'source_signature': list(signature),
+                         'fields': fields, 'sentence_count': sentence_count, 'terms': terms}).encode('utf-8')
+    with open(index_path, 'wb') as file:
+        file.write(INDEX_MAGIC)
+        file.write(struct.pack('<Q', len(header)))
+        file.write(header)
+        for postings in term_dict.values():
+            if sys.byteorder != 'little':
+                postings.byteswap()
+            postings.tofile(file)
+    return InvertedIndex.load(index_path)
+
+def load_inverted_index(conllu_path : str, index_path : str = None, rebuild : bool = True) -> InvertedIndex|None:
+    # loads the index next to conllu_path, (re)building it if missing or out of date
+    index_path = index_path if index_path else conllu_path + INDEX_EXTENSION
+    if os.path.exists(index_path):
+        index = InvertedIndex.load(index_path)
+        if index.is_current():
+            return index
+    return build_inverted_index(conllu_path, index_path) if rebuild else None
+
+def search_indexed(conllu_path : str, expr : str|Search, index_path : str = None) \
+        -> Generator[Tuple[str, List[Match]|List[Tree]], None, None]:
+    return load_inverted_index(conllu_path, index_path).search(expr)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build an inverted index over a conllu file')
+    parser.add_argument('conllu_path')
+    parser.add_argument('-o', '--output', default=None, help='index path (default: <conllu_path>%s)' % INDEX_EXTENSION)
+    parser.add_argument('-f', '--fields', nargs='+', default=DEFAULT_INDEXED_FIELDS)
+    args = parser.parse_args()
+    index = build_inverted_index(args.conllu_path, args.output, args.fields)
+    print('%d sentences, %d terms -> %s' % (index.sentence_count, len(index.terms()), index.index_path))
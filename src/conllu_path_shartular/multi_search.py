@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import threading
+from collections import defaultdict, Counter
+from typing import Dict, List, Iterable, Generator, Tuple, Hashable
+
+from conllu_path_shartular.search import Search, Match
+from conllu_path_shartular.search_evaluator import Evaluator, ValueComparer, ConstantEvaluator, \
+    NodePathEvaluator, Operation, Predicate, Step
+from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree
+
+def evaluator_key(evaluator : Evaluator) -> Hashable:
+    # equal for evaluators that test the same thing, whatever the order of their values
+    if isinstance(evaluator, ValueComparer):
+        return evaluator.operator, tuple(evaluator.key), tuple(sorted(evaluator.values))
+    if isinstance(evaluator, ConstantEvaluator):
+        return '*', evaluator.evaluate(None)
+    if isinstance(evaluator, Operation):
+        return (evaluator.operator.value, evaluator_key(evaluator.left),
+                evaluator_key(evaluator.right) if evaluator.right else None)
+    if isinstance(evaluator, NodePathEvaluator):
+        return evaluator.path_type, evaluator_key(evaluator.evaluator)
+    return 'id', id(evaluator)
+
+class _SharedEvaluator(Evaluator):
+    # Stands for every occurrence of one subexpression across the queries. It is compiled once,
+    # and, if memoized, evaluated at most once per node during a MultiSearch.match call.
+    def __init__(self, evaluator : Evaluator, memoize : bool, local : threading.local):
+        self.evaluator = evaluator
+        self.memoize = memoize
+        self._local = local
+        self._compiled : Tuple[Dict[str, int], Predicate] = (None, None)
+    def evaluate(self, node : Tree) -> bool:
+        return self.evaluator.evaluate(node)
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        compiled_key_index_dict, predicate = self._compiled
+        if predicate is not None and compiled_key_index_dict is key_index_dict:
+            return predicate
+        predicate = self.evaluator.compile(key_index_dict)
+        if self.memoize:
+            local, compute, slot = self._local, predicate, id(self)
+            def predicate(node : Tree) -> bool:
+                memo = local.memo
+                key = (slot, id(node))
+                value = memo.get(key)
+                if value is None:
+                    value = memo[key] = compute(node)
+                return value
+        self._compiled = (key_index_dict, predicate)
+        return predicate
+    def __str__(self):
+        return self.evaluator.__str__()
+    def __repr__(self):
+        return self.__str__()
+
+class _StepNode:
+    # a node of the trie of query paths; queries with a common prefix of steps share its nodes
+    def __init__(self, evaluator : NodePathEvaluator = None):
+        self.evaluator = evaluator
+        self.children : Dict[Hashable, _StepNode] = {}
+        self.query_ids : List[Hashable] = [] # queries whose last step this is
+    def iter_nodes(self) -> Generator[_StepNode, None, None]:
+        for child in self.children.values():
+            yield child
+            yield from child.iter_nodes()
+
+class MultiSearch:
+    # Evaluates many queries against each tree in one pass. Identical path prefixes are walked
+    # once, identical value tests are compiled once and identical compound or path
+    # sub-queries are evaluated once per node.
+    def __init__(self, exprs : Dict[Hashable, str|Search] | Iterable[str|Search]):
+        if not isinstance(exprs, dict):
+            exprs = dict(enumerate(exprs))
+        self.searches = {qid: Search(expr) if isinstance(expr, str) else expr for qid, expr in exprs.items()}
+        self._local = threading.local()
+        self._trie = _StepNode()
+        for qid, search in self.searches.items():
+            if not search.evaluator_sequence:
+                continue # matches nothing, like Search.match
+            step_node = self._trie
+            for step in search.evaluator_sequence:
+                key = evaluator_key(step)
+                if key not in step_node.children:
+                    step_node.children[key] = _StepNode(step)
+                step_node = step_node.children[key]
+            step_node.query_ids.append(qid)
+        self._share_subexpressions()
+        self._plan : Tuple[Dict[str, int], Dict[_StepNode, Step]] = (None, None)
+
+    def _share_subexpressions(self):
+        step_nodes = list(self._trie.iter_nodes())
+        counts = Counter()
+        def count(evaluator : Evaluator):
+            counts[evaluator_key(evaluator)] += 1
+            if isinstance(evaluator, Operation):
+                count(evaluator.left)
+                if evaluator.right:
+                    count(evaluator.right)
+            elif isinstance(evaluator, NodePathEvaluator):
+                count(evaluator.evaluator)
+        for step_node in step_nodes:
+            count(step_node.evaluator.evaluator)
+        shared : Dict[Hashable, _SharedEvaluator] = {}
+        def share(evaluator : Evaluator) -> Evaluator:
+            key = evaluator_key(evaluator)
+            if key in shared:
+                return shared[key]
+            if isinstance(evaluator, Operation):
+                evaluator = Operation(evaluator.operator, share(evaluator.left),
+                                      share(evaluator.right) if evaluator.right else None)
+            elif isinstance(evaluator, NodePathEvaluator):
+                evaluator = NodePathEvaluator(evaluator.path_type, share(evaluator.evaluator))
+            if counts[key] < 2:
+                return evaluator
+            memoize = not isinstance(evaluator, (ValueComparer, ConstantEvaluator)) # cheaper to recompute
+            shared[key] = _SharedEvaluator(evaluator, memoize, self._local)
+            return shared[key]
+        for step_node in step_nodes:
+            step_node.evaluator = NodePathEvaluator(step_node.evaluator.path_type,
+                                                    share(step_node.evaluator.evaluator))
+
+    def _steps(self, tree : Tree) -> Dict[_StepNode, Step]:
+        key_index_dict = getattr(tree, 'key_index_dict', None)
+        plan_key_index_dict, steps = self._plan
+        if steps is None or plan_key_index_dict is not key_index_dict:
+            steps = {step_node: step_node.evaluator.compile_step(key_index_dict)
+                     for step_node in self._trie.iter_nodes()}
+            self._plan = (key_index_dict, steps)
+        return steps
+
+    def match(self, tree : Tree) -> Dict[Hashable, List[Match]]:
+        # the result of Search.match for every query that matches, by query id
+        self._local.memo = {}
+        try:
+            return dict(self._walk(self._trie, tree, self._steps(tree)))
+        finally:
+            self._local.memo = {}
+
+    def _walk(self, step_node : _StepNode, node : Tree, steps : Dict[_StepNode, Step]) \
+            -> Dict[Hashable, List[Match]]:
+        results = defaultdict(list)
+        for child in step_node.children.values():
+            node_lister, predicate = steps[child]
+            for n in node_lister(node):
+                if not predicate(n):
+                    continue
+                for qid in child.query_ids:
+                    results[qid].append(Match(n))
+                if child.children:
+                    for qid, next_matches in self._walk(child, n, steps).items():
+                        results[qid].append(Match(n, next_matches))
+        return results
+
+    def search(self, sentences : Iterable[Sentence]) \
+            -> Generator[Tuple[Sentence, Dict[Hashable, List[Match]]], None, None]:
+        # yields each sentence matched by at least one query, with the matches by query id
+        for sentence in sentences:
+            if not sentence:
+                continue
+            results = self.match(sentence.root)
+            if results:
+                yield sentence, results
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Generator, Tuple
+
+from conllu_path_shartular.conllu import conllu_fields, conllu_index_dict, field_is_dict, _dict_field_parsers, \
+    iter_sentences_from_conllu, file_signature, EMPTY_FIELD
+from conllu_path_shartular.sentence import Sentence, ROOT_HEAD, NO_HEAD
+from conllu_path_shartular.tree import FixedKeysNode, LazyField
+
+PARSED_CACHE_MAGIC = b'CPPCCH2\n'
+PARSED_CACHE_EXTENSION = '.cpc'
+NO_STRING = -1 # code of a missing value; indexes the trailing None of the string table
+# the arrays of a cache file, in file order: name, array typecode
+_SECTIONS = (('string_offsets', 'q'), ('strings', 'B'), ('string_kinds', 'B'), ('fields', 'i'), ('heads', 'i'),
+             ('sentence_starts', 'q'), ('sentences', 'i'), ('meta_starts', 'q'), ('meta', 'i'),
+             ('raw_line_tokens', 'q'), ('raw_lines', 'i'))
+_FIELD_COUNT = len(conllu_fields)
+_SENTENCE_INFO = 3 # sent_id code, text code, 1 if the sentence has a tree
+# kind of a table string: 0 for plain values, else 1 + the index in field_is_dict of the field it is a raw value of
+_column_kinds = [field_is_dict.index(label) + 1 if label in field_is_dict else 0 for label in conllu_fields]
+_kind_parsers = [None] + [_dict_field_parsers[label] for label in field_is_dict]
+
+def _align(offset : int) -> int:
+    return (offset + 7) & ~7
+
+def _field_string(value) -> str|None:
+    if value.__class__ is LazyField:
+        return value.raw
+    return value if value else None
+
+def _joined_fields(fields : List[str|LazyField|None]) -> str:
+    # the line of a node with these fields as read, which is its source line unless stored otherwise
+    return '\t'.join([v if v.__class__ is str else EMPTY_FIELD if v is None else v.raw for v in fields])
+
+_AS_READ = object() # stands for the source line of a _CachedNode that is its fields joined
+
+class _CachedNode(FixedKeysNode):
+    # a node read from a cache; its source line is either stored in the cache or its fields as
+    # read joined by tabs, which is only done when the line is first asked for
+    def raw_line(self) -> str|None:
+        line = super().raw_line()
+        if line is _AS_READ:
+            line = self._raw_line = _joined_fields(self._source if self._source is not None else self._dlist)
+        return line
+
+def build_parsed_cache(conllu_path : str, cache_path : str = None) -> ParsedCache:
+    # Parses conllu_path once and stores its sentences: a table of all distinct strings, the
+    # string codes of every token's fields, the head position of every token and sentence metadata.
+    # Source lines are stored for the few tokens whose line is not just their fields joined by tabs,
+    # so that nodes read back keep their source line as with the text parser.
+    cache_path = cache_path if cache_path else conllu_path + PARSED_CACHE_EXTENSION
+    signature = file_signature(conllu_path)
+    codes : Dict[Tuple[int, str], int] = {}
+    def code(s : str|None, kind : int = 0) -> int:
+        if s is None:
+            return NO_STRING
+        c = codes.get((kind, s))
+        if c is None:
+            c = codes[(kind, s)] = len(codes)
+        return c
+    sections = {name: array(typecode) for name, typecode in _SECTIONS}
+    fields, heads, sentences, meta = sections['fields'], sections['heads'], sections['sentences'], sections['meta']
+    raw_line_tokens, raw_lines = sections['raw_line_tokens'], sections['raw_lines']
+    sections['sentence_starts'].append(0)
+    sections['meta_starts'].append(0)
+    for sentence in iter_sentences_from_conllu(conllu_path, use_cache=False):
+        positions = {id(node): i for i, node in enumerate(sentence.sequence)}
+        for node in sentence.sequence:
+            field_strings = [_field_string(node._dlist[i]) for i in range(_FIELD_COUNT)]
+            fields.extend([code(s, kind) for s, kind in zip(field_strings, _column_kinds)])
+            if node._raw_line != _joined_fields(field_strings):
+                raw_line_tokens.append(len(heads))
+                raw_lines.append(code(node._raw_line))
+            if not sentence or node.parent is None:
+                heads.append(ROOT_HEAD if sentence and node is sentence.root else NO_HEAD)
+            else:
+                heads.append(positions[id(node.parent)])
+        sections['sentence_starts'].append(len(heads))
+        sentences.extend([code(sentence.sent_id), code(sentence.text), 1 if sentence else 0])
+        meta.extend([code(m) for m in sentence.meta or []])
+        sections['meta_starts'].append(len(meta))
+    encoded = [s.encode('utf-8') for _, s in codes]
+    sections['string_kinds'] = array('B', [kind for kind, _ in codes])
+    string_offsets = sections['string_offsets']
+    string_offsets.append(0)
+    for s in encoded:
+        string_offsets.append(string_offsets[-1] + len(s))
+    sections['strings'] = array('B', b''.join(encoded))
+    layout, position = {}, 0
+    for name, _ in _SECTIONS:
+        layout[name] = [position, len(sections[name])]
+        position = _align(position + len(sections[name]) * sections[name].itemsize)
+    header = json.dumps({'source_path': os.path.abspath(conllu_path), 'source_signature': list(signature),
+                         'string_count': len(codes), 'sections': layout}).encode('utf-8')
+    data_start = _align(len(PARSED_CACHE_MAGIC) + 8 + len(header))
+    with open(cache_path, 'wb') as file:
+        file.write(PARSED_CACHE_MAGIC)
+        file.write(struct.pack('<Q', len(header)))
+        file.write(header)
+        for name, _ in _SECTIONS:
+            file.write(b'\0' * (data_start + layout[name][0] - file.tell()))
+            section = sections[name]
+            if sys.byteorder != 'little':
+                section.byteswap()
+            section.tofile(file)
+    return ParsedCache(cache_path)
+
+class ParsedCache:
+    # A cache file written by build_parsed_cache. Its arrays are read in place from a memory map;
+    # strings are decoded once each, on first use. Raw dict field values become LazyFields, which
+    # never change, so all tokens with the same value share one. Nodes keep their source line.
+    def __init__(self, cache_path : str):
+        self.cache_path = cache_path
+        with open(cache_path, 'rb') as file:
+            if file.read(len(PARSED_CACHE_MAGIC)) != PARSED_CACHE_MAGIC:
+                raise Exception('Not a parsed cache file: ' + cache_path)
+            header_len, = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(header_len).decode('utf-8'))
+            self._mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.source_path = header['source_path']
+        self.source_signature = tuple(header['source_signature'])
+        data_start = _align(len(PARSED_CACHE_MAGIC) + 8 + header_len)
+        view = memoryview(self._mapped)
+        self._views : List[memoryview] = [view]
+        self._sections : Dict[str, memoryview|array] = {}
+        for name, typecode in _SECTIONS:
+            offset, count = header['sections'][name]
+            start = data_start + offset
+            section = view[start:start + count * array(typecode).itemsize].cast(typecode)
+            if sys.byteorder != 'little': # copied, since the file is little endian
+                section = array(typecode, section)
+                section.byteswap()
+            else:
+                self._views.append(section)
+            self._sections[name] = section
+        self._values : List[str|LazyField|None] = [None] * (header['string_count'] + 1) # last one for NO_STRING
+
+    def is_current(self) -> bool:
+        return os.path.exists(self.source_path) and file_signature(self.source_path) == self.source_signature
+
+    def __len__(self):
+        return len(self._sections['sentences']) // _SENTENCE_INFO
+
+    def _decode(self, codes : List[int]):
+        values, offsets, blob = self._values, self._sections['string_offsets'], self._sections['strings']
+        kinds = self._sections['string_kinds']
+        for c in codes:
+            if c != NO_STRING and values[c] is None:
+                value = bytes(blob[offsets[c]:offsets[c + 1]]).decode('utf-8')
+                values[c] = LazyField(value, _kind_parsers[kinds[c]]) if kinds[c] else value
+
+    def _raw_line_range(self, start : int, end : int) -> Tuple[int, int]:
+        # the positions in raw_line_tokens of the tokens from start to end
+        tokens = self._sections['raw_line_tokens']
+        return bisect_left(tokens, start), bisect_left(tokens, end)
+
+    def sentence(self, i : int) -> Sentence:
+        start, end = self._sections['sentence_starts'][i], self._sections['sentence_starts'][i + 1]
+        self._decode(self._sections['fields'][start * _FIELD_COUNT:end * _FIELD_COUNT].tolist())
+        first, last = self._raw_line_range(start, end)
+        self._decode(self._sections['raw_lines'][first:last].tolist())
+        meta_start, meta_end = self._sections['meta_starts'][i], self._sections['meta_starts'][i + 1]
+        self._decode(self._sections['meta'][meta_start:meta_end].tolist())
+        self._decode(self._sections['sentences'][i * _SENTENCE_INFO:(i + 1) * _SENTENCE_INFO - 1].tolist())
+        return self._sentence(i)
+
+    def _sentence(self, i : int) -> Sentence:
+        # expects the strings of sentence i to be decoded
+        sections, values = self._sections, self._values
+        start, end = sections['sentence_starts'][i], sections['sentence_starts'][i + 1]
+        fields = [values[c] for c in sections['fields'][start * _FIELD_COUNT:end * _FIELD_COUNT].tolist()]
+        nodes = [_CachedNode(fields[t:t + _FIELD_COUNT], conllu_index_dict, raw_line=_AS_READ)
+                 for t in range(0, len(fields), _FIELD_COUNT)]
+        first, last = self._raw_line_range(start, end)
+        raw_line_tokens, raw_lines = sections['raw_line_tokens'][first:last], sections['raw_lines'][first:last]
+        for token, c in zip(raw_line_tokens.tolist(), raw_lines.tolist()):
+            nodes[token - start]._raw_line = values[c]
+        sent_id, text, has_tree = sections['sentences'][i * _SENTENCE_INFO:(i + 1) * _SENTENCE_INFO].tolist()
+        kwargs = {}
+        if sent_id != NO_STRING:
+            kwargs['sent_id'] = values[sent_id]
+        if text != NO_STRING:
+            kwargs['text'] = values[text]
+        meta = [values[c] for c in sections['meta'][sections['meta_starts'][i]:sections['meta_starts'][i + 1]]]
+        if meta:
+            kwargs['meta'] = meta
+        if has_tree:
+            kwargs['heads'] = sections['heads'][start:end].tolist()
+        return Sentence(nodes, **kwargs)
+
+    def __iter__(self) -> Generator[Sentence, None, None]:
+        self._decode(range(len(self._values) - 1))
+        for i in range(len(self)):
+            yield self._sentence(i)
+
+    def close(self):
+        for view in reversed(self._views): # a map cannot be closed while exported
+            view.release()
+        self._views = []
+        self._sections = {}
+        self._mapped.close()
+
+def _has_magic(cache_path : str) -> bool:
+    with open(cache_path, 'rb') as file:
+        return file.read(len(PARSED_CACHE_MAGIC)) == PARSED_CACHE_MAGIC
+
+def load_parsed_cache(conllu_path : str, cache_path : str = None, rebuild : bool = True) -> ParsedCache|None:
+    # loads the cache next to conllu_path, (re)building it if missing, out of date or of an older format
+    cache_path = cache_path if cache_path else conllu_path + PARSED_CACHE_EXTENSION
+    if os.path.exists(cache_path) and _has_magic(cache_path):
+        cache = ParsedCache(cache_path)
+        if cache.is_current():
+            return cache
+        cache.close()
+    return build_parsed_cache(conllu_path, cache_path) if rebuild else None
+
+def iter_cached_sentences(conllu_path : str, cache_path : str = None) -> Generator[Sentence, None, None]|None:
+    # the sentences of conllu_path from an up to date cache, None if there is none
+    cache = load_parsed_cache(conllu_path, cache_path, rebuild=False)
+    return None if cache is None else _iter_closing(cache)
+
+def _iter_closing(cache : ParsedCache) -> Generator[Sentence, None, None]:
+    try:
+        yield from cache
+    finally:
+        cache.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write the parsed cache of a conllu file')
+    parser.add_argument('conllu_path')
+    parser.add_argument('-o', '--output', default=None,
+                        help='cache path (default: <conllu_path>%s)' % PARSED_CACHE_EXTENSION)
+    args = parser.parse_args()
+    cache = build_parsed_cache(args.conllu_path, args.output)
+    print('%d sentences -> %s' % (len(cache), cache.cache_path))
+    cache.close()
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from conllu_path_shartular.search_evaluator import Evaluator, ValueComparer, ConstantEvaluator, \
+    NodePathEvaluator, Operation, Operator, NodeLister, Predicate, Step
+from conllu_path_shartular.tree import Tree
+
+def query_text(evaluator : Evaluator, parenthesize : bool = False) -> str:
+    # the evaluator written in query syntax
+    if isinstance(evaluator, ValueComparer):
+        return '.'.join(evaluator.key) + evaluator.operator + ','.join(sorted(evaluator.values))
+    if isinstance(evaluator, ConstantEvaluator):
+        return str(evaluator)
+    if isinstance(evaluator, NodePathEvaluator):
+        return evaluator.path_type + '[' + query_text(evaluator.evaluator) + ']'
+    if isinstance(evaluator, Operation):
+        if evaluator.operator == Operator.NOT:
+            return '!' + query_text(evaluator.left, True)
+        text = query_text(evaluator.left, True) + ' ' + evaluator.operator.value + ' ' + \
+               query_text(evaluator.right, True)
+        return '(' + text + ')' if parenthesize else text
+    if isinstance(evaluator, _ProfiledEvaluator):
+        return query_text(evaluator.evaluator, parenthesize)
+    return str(evaluator)
+
+class EvaluatorStats:
+    __slots__ = ('calls', 'visited', 'hits', 'seconds')
+    def __init__(self):
+        self.calls = 0 # tests, or for path steps, nodes the path was followed from
+        self.visited = 0 # nodes listed along the path
+        self.hits = 0 # tests that were true
+        self.seconds = 0.0 # including the evaluators below
+
+class _ProfiledEvaluator(Evaluator):
+    # counts the calls of the predicate compiled from evaluator
+    def __init__(self, evaluator : Evaluator, stats : EvaluatorStats):
+        self.evaluator = evaluator
+        self.stats = stats
+    def evaluate(self, node : Tree) -> bool:
+        return self.evaluator.evaluate(node)
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        return _profiled_predicate(self.evaluator.compile(key_index_dict), self.stats)
+    def __str__(self):
+        return self.evaluator.__str__()
+
+class _ProfiledPath(NodePathEvaluator):
+    # a path test that also counts the nodes it lists
+    def __init__(self, path_type : str, evaluator : Evaluator, stats : EvaluatorStats):
+        super().__init__(path_type, evaluator)
+        self.stats = stats
+    def _node_lister(self) -> NodeLister:
+        return _profiled_lister(super()._node_lister(), self.stats)
+
+def _profiled_predicate(predicate : Predicate, stats : EvaluatorStats) -> Predicate:
+    def profiled(node : Tree) -> bool:
+        stats.calls += 1
+        start = perf_counter()
+        result = predicate(node)
+        stats.seconds += perf_counter() - start
+        if result:
+            stats.hits += 1
+        return result
+    return profiled
+
+def _profiled_lister(node_lister : NodeLister, stats : EvaluatorStats, timed : bool = False) -> NodeLister:
+    def profiled(node : Tree) -> List[Tree]:
+        start = perf_counter() if timed else 0.0
+        nodes = node_lister(node)
+        stats.visited += len(nodes)
+        if timed:
+            stats.calls += 1
+            stats.seconds += perf_counter() - start
+        return nodes
+    return profiled
+
+class QueryProfile:
+    # Counters for every step and sub-expression of a Search, filled while it is profiling
+    # (see Search.start_profiling). Search then runs an instrumented copy of its plan; the
+    # plan used otherwise is untouched, so profiling costs nothing while it is off.
+    # The counters are not locked, so profile one thread at a time.
+    def __init__(self, evaluator_sequence : List[NodePathEvaluator], expr_src : str = None):
+        self.expr_src = expr_src
+        self.parse_seconds = None
+        if expr_src is not None:
+            from conllu_path_shartular.expr_parser import parse_evaluator
+            start = perf_counter()
+            parse_evaluator(expr_src)
+            self.parse_seconds = perf_counter() - start
+        self.entries : List[Tuple[int, Evaluator, EvaluatorStats]] = [] # depth, evaluator, stats; in query order
+        self._steps : List[Tuple[NodePathEvaluator, Evaluator, EvaluatorStats]] = []
+        for step in evaluator_sequence:
+            stats = EvaluatorStats()
+            self.entries.append((0, step, stats))
+            self._steps.append((step, self._instrument(step.evaluator, 1), stats))
+
+    def _instrument(self, evaluator : Evaluator, depth : int) -> Evaluator:
+        stats = EvaluatorStats()
+        self.entries.append((depth, evaluator, stats))
+        if isinstance(evaluator, Operation):
+            evaluator = Operation(evaluator.operator, self._instrument(evaluator.left, depth + 1),
+                                  self._instrument(evaluator.right, depth + 1) if evaluator.right else None)
+        elif isinstance(evaluator, NodePathEvaluator):
+            evaluator = _ProfiledPath(evaluator.path_type, self._instrument(evaluator.evaluator, depth + 1), stats)
+        return _ProfiledEvaluator(evaluator, stats)
+
+    def compile(self, key_index_dict : Dict[str, int] = None) -> List[Step]:
+        steps = []
+        for step, evaluator, stats in self._steps:
+            node_lister = _profiled_lister(step._node_lister(), stats, timed=True)
+            predicate = evaluator.compile(key_index_dict)
+            def step_predicate(node : Tree, predicate=predicate, stats=stats) -> bool:
+                start = perf_counter()
+                result = predicate(node)
+                stats.seconds += perf_counter() - start
+                if result:
+                    stats.hits += 1
+                return result
+            steps.append((node_lister, step_predicate))
+        return steps
+
+    def trees_searched(self) -> int:
+        return self.entries[0][2].calls if self.entries else 0
+
+    def report(self) -> str:
+        # one line per step, and indented below it, per sub-expression
+        lines = []
+        if self.expr_src is not None:
+            lines.append('query: %s (parsed in %.3f ms)' % (self.expr_src, self.parse_seconds * 1000))
+        lines.append('trees searched: %d' % self.trees_searched())
+        rows = [('  ' * depth + (query_text(evaluator) if depth else evaluator.path_type + ' step: ' +
+                                 query_text(evaluator)), stats) for depth, evaluator, stats in self.entries]
+        width = max([len(text) for text, _ in rows] + [10])
+        lines.append('%-*s %10s %10s %10s %10s' % (width, 'expression', 'calls', 'visited', 'true', 'time ms'))
+        for text, stats in rows:
+            lines.append('%-*s %10d %10s %10d %10.3f' % (width, text, stats.calls, stats.visited if stats.visited else '',
+                                                       stats.hits, stats.seconds * 1000))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
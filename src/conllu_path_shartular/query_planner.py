@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from collections import defaultdict, Counter
+from typing import Dict, List, Iterable, Tuple, TYPE_CHECKING
+
+from conllu_path_shartular.search_evaluator import Evaluator, ValueComparer, ConstantEvaluator, \
+    NodePathEvaluator, Operation, Operator
+from conllu_path_shartular.tree import Tree
+
+if TYPE_CHECKING:
+    from conllu_path_shartular.sentence import Sentence
+
+VALUE_TEST_COST = 1.0
+PATH_COST = 20.0 # a path sub-query visits several nodes, so it is always tried last
+UNKNOWN_SELECTIVITY = 0.5
+
+class CorpusStatistics:
+    def __init__(self, fields : Iterable[str] = None):
+        # fields: top-level fields to count (all if None). Dict fields are counted per key,
+        # e.g. 'feats.Case'
+        self.fields = set(fields) if fields is not None else None
+        self.token_count = 0
+        self.value_counts : Dict[str, Counter] = defaultdict(Counter)
+
+    @staticmethod
+    def from_sentences(sentences : Iterable[Sentence], fields : Iterable[str] = None) -> CorpusStatistics:
+        stats = CorpusStatistics(fields)
+        for sentence in sentences:
+            stats.add_sentence(sentence)
+        return stats
+
+    def add_sentence(self, sentence : Sentence):
+        for node in sentence.sequence:
+            self.add_node(node)
+
+    def add_node(self, node : Tree):
+        self.token_count += 1
+        for key in node.keys():
+            if self.fields is not None and key not in self.fields:
+                continue
+            value = node.data(key)
+            if isinstance(value, str):
+                self.value_counts[key][value] += 1
+            elif isinstance(value, Tree):
+                for sub_key in value.keys():
+                    sub_value = value.data(sub_key)
+                    sub_value = {sub_value} if isinstance(sub_value, str) else sub_value
+                    if not sub_value or isinstance(sub_value, Tree):
+                        continue
+                    self.value_counts[key + Tree.PATH_SEPARATOR + sub_key].update(sub_value)
+
+    def merge(self, other : CorpusStatistics):
+        self.token_count += other.token_count
+        for key, counter in other.value_counts.items():
+            self.value_counts[key].update(counter)
+
+    def is_counted(self, key : List[str]) -> bool:
+        return self.fields is None or key[0] in self.fields
+
+    def frequency(self, key : List[str], values : Iterable[str]) -> float:
+        # estimated fraction of tokens for which key has one of the values
+        if not self.token_count or not self.is_counted(key):
+            return UNKNOWN_SELECTIVITY
+        counter = self.value_counts.get(Tree.PATH_SEPARATOR.join(key))
+        if counter is None:
+            return 0.0
+        return min(1.0, sum(counter[v] for v in values) / self.token_count)
+
+def estimate(evaluator : Evaluator, stats : CorpusStatistics) -> Tuple[float, float]:
+    # returns (probability of being true, cost)
+    if isinstance(evaluator, ConstantEvaluator):
+        return (1.0 if evaluator.evaluate(None) else 0.0), 0.0
+    if isinstance(evaluator, ValueComparer):
+        return stats.frequency(evaluator.key, evaluator.values), VALUE_TEST_COST
+    if isinstance(evaluator, NodePathEvaluator):
+        _, cost = estimate(evaluator.evaluator, stats)
+        return UNKNOWN_SELECTIVITY, PATH_COST * (1 + cost)
+    if isinstance(evaluator, Operation):
+        p_left, cost_left = estimate(evaluator.left, stats)
+        if evaluator.operator == Operator.NOT:
+            return 1 - p_left, cost_left
+        p_right, cost_right = estimate(evaluator.right, stats)
+        if evaluator.operator == Operator.AND:
+            return p_left * p_right, cost_left + cost_right
+        return 1 - (1 - p_left) * (1 - p_right), cost_left + cost_right
+    return UNKNOWN_SELECTIVITY, VALUE_TEST_COST
+
+def _operands(evaluator : Evaluator, operator : Operator) -> List[Evaluator]:
+    # flattens a chain of the same binary operator
+    if isinstance(evaluator, Operation) and evaluator.operator == operator:
+        return _operands(evaluator.left, operator) + _operands(evaluator.right, operator)
+    return [evaluator]
+
+def _rank(evaluator : Evaluator, operator : Operator, stats : CorpusStatistics) -> float:
+    # cost per chance of deciding the result; AND is decided by a false operand, OR by a true one
+    p, cost = estimate(evaluator, stats)
+    decisive = 1 - p if operator == Operator.AND else p
+    return cost / decisive if decisive > 0 else float('inf')
+
+def optimize(evaluator : Evaluator, stats : CorpusStatistics) -> Evaluator:
+    # returns an equivalent evaluator with AND/OR operands reordered so that cheap, decisive tests run first
+    if isinstance(evaluator, NodePathEvaluator):
+        return NodePathEvaluator(evaluator.path_type, optimize(evaluator.evaluator, stats))
+    if not isinstance(evaluator, Operation):
+        return evaluator
+    if evaluator.operator == Operator.NOT:
+        return Operation(Operator.NOT, optimize(evaluator.left, stats))
+    operands = [optimize(e, stats) for e in _operands(evaluator, evaluator.operator)]
+    operands.sort(key=lambda e: _rank(e, evaluator.operator, stats))
+    result = operands[0]
+    for operand in operands[1:]:
+        result = Operation(evaluator.operator, result, operand)
+    return result
+
+def optimize_sequence(evaluator_sequence : List[NodePathEvaluator], stats : CorpusStatistics) \
+        -> List[NodePathEvaluator]:
+    return [optimize(evaluator, stats) for evaluator in evaluator_sequence]
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from typing import Generator, Iterable, List, Tuple
+
+from conllu_path_shartular.conllu import file_signature
+from conllu_path_shartular.corpus import DEFAULT_CHUNK_SIZE, search_corpus
+from conllu_path_shartular.profiling import query_text
+from conllu_path_shartular.search import Search, Match, query_cache
+from conllu_path_shartular.tree import Tree
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'conllu_path_shartular')
+DEFAULT_MAX_BYTES = 1 << 28
+RESULT_EXTENSION = '.json'
+
+IdResult = Tuple[str, List[List[str]]] # sent_id, the node ids of every complete match path
+
+def normalized_query(expr : str|Search) -> str:
+    # the same text for queries that differ only in spacing or in the order of listed values
+    search = query_cache.get(expr) if isinstance(expr, str) else expr
+    return ''.join(query_text(step) for step in search.evaluator_sequence)
+
+def match_id_paths(matches : List[Match]|List[Tree]) -> List[List[str]]:
+    # the node ids of every complete match path, as Search.iter_matches gives them
+    paths = []
+    for match in matches:
+        if not isinstance(match, Match):
+            paths.append([match.id()])
+        elif not match.next_matches:
+            paths.append([match.node.id()])
+        else:
+            paths.extend([match.node.id()] + path for path in match_id_paths(match.next_matches))
+    return paths
+
+class ResultCache:
+    # On-disk cache of corpus search results, one file per (normalized query, conllu file). An entry
+    # holds the file's size and mtime and is dropped when they change. Entries are evicted least
+    # recently used first, keeping the directory under max_bytes. Safe to share between processes.
+    def __init__(self, directory : str = DEFAULT_CACHE_DIRECTORY, max_bytes : int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, query : str, conllu_path : str) -> str:
+        key = json.dumps([query, os.path.abspath(conllu_path)])
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + RESULT_EXTENSION)
+
+    def get(self, expr : str|Search, conllu_path : str) -> List[IdResult]|None:
+        query = normalized_query(expr)
+        entry_path = self._entry_path(query, conllu_path)
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError): # missing, or being replaced
+            self.misses += 1
+            return None
+        if entry['query'] != query or entry['source_signature'] != list(file_signature(conllu_path)):
+            self._remove(entry_path) # the file changed
+            self.misses += 1
+            return None
+        os.utime(entry_path) # most recently used
+        self.hits += 1
+        return [(sent_id, paths) for sent_id, paths in entry['results']]
+
+    def put(self, expr : str|Search, conllu_path : str, results : List[IdResult]):
+        query = normalized_query(expr)
+        entry = {'query': query, 'source_path': os.path.abspath(conllu_path),
+                 'source_signature': list(file_signature(conllu_path)), 'results': results}
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+            json.dump(entry, file)
+        os.replace(temp_path, self._entry_path(query, conllu_path))
+        self._evict()
+
+    def search(self, path_or_paths : str|Iterable[str], expr : str|Search, workers : int = None,
+               chunk_size : int = DEFAULT_CHUNK_SIZE, indexed : bool = False) -> Generator[IdResult, None, None]:
+        # like search_corpus, with matches given as node id paths; files with a cached result are not read
+        paths = [path_or_paths] if isinstance(path_or_paths, str) else list(path_or_paths)
+        for path in paths:
+            results = self.get(expr, path)
+            if results is None:
+                results = [(sent_id, match_id_paths(matches))
+                           for sent_id, matches in search_corpus(path, expr, workers, True, chunk_size, indexed)]
+                self.put(expr, path, results)
+            yield from results
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(RESULT_EXTENSION):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path : str):
+        try:
+            os.remove(path)
+        except OSError: # already removed by another process
+            pass
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        for _, _, path in self._entries():
+            self._remove(path)
+        self.hits = self.misses = 0
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import io
+import os
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Set, Tuple, Union
+
+from conllu_path_shartular.compressed import detect_compression
+from conllu_path_shartular.conllu import iter_conllu_blocks, sentence_from_conllu_block, node_to_conllu, \
+    file_signature, conllu_fields, field_is_dict, MANY_VALS_SEP
+from conllu_path_shartular.corpus import DEFAULT_CHUNK_SIZE, Chunk, split_conllu_chunks, chunk_bytes, _map_chunks
+from conllu_path_shartular.inverted_index import InvertedIndex, INDEX_EXTENSION, load_inverted_index, \
+    block_terms, write_inverted_index
+from conllu_path_shartular.search import Search, query_cache
+from conllu_path_shartular.sentence_index import SentenceIndex, SENTENCE_INDEX_EXTENSION, load_sentence_index
+from conllu_path_shartular.sentence import Sentence
+from conllu_path_shartular.tree import Tree, DictNode
+
+Assignment = Tuple[int, str, Union[str, Set[str], None]] # match level, field path such as 'deprel' or 'feats.Case', value
+Change = Tuple[int, int, int] # offset of a rewritten sentence in the source, old length, new length
+TermChange = Tuple[int, Set[str], Set[str]] # offset of a rewritten sentence in the source, terms removed, added
+
+def assign_value(node : Tree, path : str|List[str], value : str|Set[str]|None):
+    # Tree.assign, except that keys of dict fields (feats, misc, deps) are added or, for None, removed
+    path = path.split(Tree.PATH_SEPARATOR) if isinstance(path, str) else path
+    if len(path) == 1:
+        node.assign(path, value)
+        return
+    field = node.data(path[0])
+    items = field.to_dict() if isinstance(field, Tree) else {}
+    if value is None:
+        items.pop(path[1], None)
+    else:
+        items[path[1]] = set(value.split(MANY_VALS_SEP)) if isinstance(value, str) else set(value)
+        if path[0] == 'feats': # kept in the canonical order
+            items = dict(sorted(items.items(), key=lambda item: item[0].lower()))
+    node.assign([path[0]], DictNode(items) if items else None)
+
+class Rewrite:
+    # Assignments to the nodes matched by a query. The nodes of match level N are those of
+    # Match.get_matches(search.match(tree), N); all matches are found before anything is assigned.
+    def __init__(self, expr : str|Search, assignments : Iterable[Assignment]):
+        self.search = query_cache.get(expr) if isinstance(expr, str) else expr
+        self.assignments = list(assignments)
+        for level, path, _ in self.assignments:
+            if not 0 <= level < len(self.search.evaluator_sequence):
+                raise Exception('Match level %d out of range for %s' % (level, str(self.search.evaluator_sequence)))
+            keys = path.split(Tree.PATH_SEPARATOR)
+            if keys[0] not in conllu_fields or len(keys) > 2 or (len(keys) == 2 and keys[0] not in field_is_dict):
+                raise Exception('Cannot assign to ' + path)
+        self._last_level = max([level for level, _, _ in self.assignments], default=-1)
+
+    def apply(self, sentence : Sentence) -> int:
+        # makes the assignments to the matches in sentence, returns the number of nodes changed
+        return len(self._apply(sentence))
+
+    def _apply(self, sentence : Sentence) -> List[Tree]:
+        # the nodes changed
+        if not sentence or not self.assignments:
+            return []
+        levels : List[Dict[int, Tree]] = [{} for _ in range(self._last_level + 1)]
+        for path in self.search.iter_matches(sentence.root, self._last_level):
+            for level, node in enumerate(path):
+                levels[level][id(node)] = node
+        targets : Dict[int, Tuple[Tree, List[Tuple[str, str|Set[str]|None]]]] = {}
+        for level, path, value in self.assignments:
+            for key, node in levels[level].items():
+                targets.setdefault(key, (node, []))[1].append((path, value))
+        changed = []
+        for node, node_assignments in targets.values():
+            before = node_to_conllu(node)
+            for path, value in node_assignments:
+                assign_value(node, path, value)
+            if node_to_conllu(node) != before:
+                changed.append(node)
+        return changed
+
+    def rewrite_block(self, block : bytes) -> bytes|None:
+        # the raw sentence with the assignments made, or None if they change nothing;
+        # only the lines of changed nodes are written anew, all others are kept as they are
+        sentence = sentence_from_conllu_block(block)
+        changed = {id(node) for node in self._apply(sentence)}
+        if not changed:
+            return None
+        nodes = iter(sentence.sequence)
+        lines = []
+        for line in block.decode('utf-8').splitlines(True):
+            content = line.strip()
+            if content and content[0] != '#':
+                node = next(nodes)
+                if id(node) in changed:
+                    line = node_to_conllu(node) + line[len(line.rstrip('\r\n')):]
+            lines.append(line)
+        return ''.join(lines).encode('utf-8')
+
+def _rewrite_chunk(chunk : Chunk, expr : str|Search, assignments : List[Assignment], fields : List[str] = None) \
+        -> Tuple[bytes, List[Change], List[TermChange]]:
+    # the chunk rewritten, and what changed; terms of fields are compared only if fields are given
+    start = chunk[1]
+    rewrite = Rewrite(expr, assignments)
+    data = chunk_bytes(chunk)
+    output, changes, term_changes = [], [], []
+    copied = 0
+    for offset, block in iter_conllu_blocks(io.BytesIO(data)):
+        new_block = rewrite.rewrite_block(block)
+        if new_block is None:
+            continue
+        output.append(data[copied:offset])
+        output.append(new_block)
+        copied = offset + len(block)
+        changes.append((start + offset, len(block), len(new_block)))
+        if fields is not None:
+            old_terms, new_terms = block_terms(block, fields), block_terms(new_block, fields)
+            if old_terms != new_terms:
+                term_changes.append((start + offset, old_terms - new_terms, new_terms - old_terms))
+    output.append(data[copied:])
+    return b''.join(output), changes, term_changes
+
+def _offset_shifter(changes : List[Change]) -> Callable[[int], int]:
+    # maps the offset of a sentence in the source to its offset in the rewritten file
+    old_offsets = [offset for offset, _, _ in changes]
+    shifts = [0]
+    for _, old_length, new_length in changes:
+        shifts.append(shifts[-1] + new_length - old_length)
+    return lambda offset: offset + shifts[bisect_left(old_offsets, offset)]
+
+def _update_sentence_index(index : SentenceIndex, conllu_path : str, changes : List[Change]) -> SentenceIndex:
+    shift = _offset_shifter(changes)
+    new_lengths = {offset: new_length for offset, _, new_length in changes}
+    offsets = array('q', [shift(offset) for offset in index.offsets])
+    lengths = array('q', [new_lengths.get(offset, length) for offset, length in zip(index.offsets, index.lengths)])
+    return SentenceIndex(os.path.abspath(conllu_path), file_signature(conllu_path), index.sent_ids, offsets, lengths)
+
+def _update_inverted_index(index : InvertedIndex, conllu_path : str, changes : List[Change],
+                           term_changes : List[TermChange]) -> InvertedIndex:
+    shift = _offset_shifter(changes)
+    removed : Dict[str, Set[int]] = defaultdict(set)
+    added : Dict[str, List[int]] = defaultdict(list)
+    for offset, removed_terms, added_terms in term_changes:
+        for term in removed_terms:
+            removed[term].add(offset)
+        for term in added_terms:
+            added[term].append(offset)
+    term_dict = index.all_postings()
+    for term in added:
+        term_dict.setdefault(term, array('q'))
+    for term, postings in list(term_dict.items()):
+        offsets = [offset for offset in postings if offset not in removed[term]] if term in removed else postings
+        if term in added:
+            offsets = sorted(list(offsets) + added[term])
+        if offsets:
+            term_dict[term] = array('q', [shift(offset) for offset in offsets])
+        else:
+            del term_dict[term]
+    return write_inverted_index(conllu_path + INDEX_EXTENSION, conllu_path, file_signature(conllu_path),
+                                sorted(index.fields), index.sentence_count, term_dict)
+
+def rewrite_conllu(source : str, expr : str|Search, assignments : Iterable[Assignment], destination : str = None,
+                   workers : int = None, chunk_size : int = DEFAULT_CHUNK_SIZE) -> int:
+    # Makes the assignments of Rewrite(expr, assignments) in every sentence of source, writing the
+    # result to destination, or by default replacing source once done. Chunks are rewritten in
+    # worker processes as in Corpus.search; sentences left unchanged are copied byte for byte.
+    # Up to date sentence offset and inverted indexes of source are carried over to the result,
+    # adjusted for the rewritten sentences instead of rebuilt. Returns the number of sentences changed.
+    # A compressed source is written out uncompressed, so it cannot be rewritten in place.
+    destination = source if destination is None else destination
+    if os.path.abspath(destination) == os.path.abspath(source) and detect_compression(source) is not None:
+        raise Exception('Cannot rewrite a compressed file in place: ' + source)
+    assignments = list(assignments)
+    Rewrite(expr, assignments) # fail early on bad assignments
+    sentence_index = load_sentence_index(source, rebuild=False)
+    inverted_index = load_inverted_index(source, rebuild=False)
+    fields = sorted(inverted_index.fields) if inverted_index is not None else None
+    changes : List[Change] = []
+    term_changes : List[TermChange] = []
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination)), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            for output, chunk_changes, chunk_term_changes in \
+                    _map_chunks(partial(_rewrite_chunk, expr=expr, assignments=assignments, fields=fields),
+                                split_conllu_chunks(source, chunk_size), workers):
+                file.write(output)
+                changes.extend(chunk_changes)
+                term_changes.extend(chunk_term_changes)
+        shutil.copymode(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    if sentence_index is not None:
+        _update_sentence_index(sentence_index, destination, changes).save(destination + SENTENCE_INDEX_EXTENSION)
+    if inverted_index is not None:
+        _update_inverted_index(inverted_index, destination, changes, term_changes)
+    return len(changes)
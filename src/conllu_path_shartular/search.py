@@ -1,11 +1,17 @@
 from __future__ import annotations
 
-from typing import List
+import threading
+from collections import namedtuple, OrderedDict, Counter
+from typing import List, Dict, Tuple, Generator, Iterable
 
-from conllu_path_shartular.search_evaluator import NodePathEvaluator
-from conllu_path_shartular.expr_parser import parse_evaluator
+from conllu_path_shartular.conllu import format_dict_field
+from conllu_path_shartular.search_evaluator import NodePathEvaluator, Step
+from conllu_path_shartular.query_planner import CorpusStatistics, optimize_sequence
+from conllu_path_shartular.profiling import QueryProfile
 from conllu_path_shartular.tree import Tree
 
+GroupKey = Tuple[int, str] # match level, field path
+
 class Match:
     def __init__(self, node : Tree, children : List[Match] = None):
         self.node = node
@@ -31,30 +37,217 @@ class Match:
 
 
 class Search:
-    def __init__(self, expr : str|List[NodePathEvaluator]):
+    def __init__(self, expr : str|List[NodePathEvaluator], statistics : CorpusStatistics = None):
+        # statistics: if given, boolean operands are reordered so the most selective tests run first
         self.expr_src = None
+        self.profile : QueryProfile|None = None
+        self._plan : Tuple[Dict[str, int], List[Step]] = (None, None)
         if isinstance(expr, str):
             self.expr_src = expr
-            expr = parse_evaluator(expr)
+            cached = query_cache.get(expr)
+            expr = cached.evaluator_sequence
+            self._plan = cached._plan # evaluators and compiled plans are stateless, so they can be shared
+        if statistics is not None:
+            expr = optimize_sequence(expr, statistics)
+            self._plan = (None, None)
         self.evaluator_sequence = expr
+    def __getstate__(self) -> Dict:
+        # compiled plans are closures and cannot be pickled; worker processes compile their own
+        state = dict(self.__dict__)
+        state['_plan'] = (None, None)
+        state['profile'] = None
+        return state
+    def __setstate__(self, state : Dict):
+        self.__dict__.update(state)
+    def compile(self, key_index_dict : Dict[str, int] = None) -> List[Step]:
+        if self.profile is not None:
+            return self.profile.compile(key_index_dict)
+        return [evaluator.compile_step(key_index_dict) for evaluator in self.evaluator_sequence]
+
+    def start_profiling(self) -> QueryProfile:
+        # until stop_profiling, matching counts calls, visited nodes, results and time per sub-expression
+        self.profile = QueryProfile(self.evaluator_sequence, self.expr_src)
+        self._plan = (None, None)
+        return self.profile
+    def stop_profiling(self) -> QueryProfile|None:
+        profile = self.profile
+        self.profile = None
+        self._plan = (None, None)
+        return profile
+    def explain(self, trees : Iterable[Tree]) -> QueryProfile:
+        # profiles matching trees (or sentences); str() of the result is the report
+        profile = self.start_profiling()
+        try:
+            for tree in trees:
+                tree = getattr(tree, 'root', tree)
+                if tree is not None:
+                    self.match(tree)
+        finally:
+            self.stop_profiling()
+        return profile
+    def _steps(self, tree : Tree) -> List[Step]:
+        # plans are compiled for the field layout of the tree being searched. The plan is
+        # replaced as a whole, never modified, and matching keeps its state on the stack,
+        # so a Search can be shared between threads
+        key_index_dict = getattr(tree, 'key_index_dict', None)
+        plan_key_index_dict, steps = self._plan
+        if steps is None or plan_key_index_dict is not key_index_dict:
+            steps = self.compile(key_index_dict)
+            self._plan = (key_index_dict, steps)
+        return steps
     def match(self, tree : Tree) -> List[Match]|List[Tree]:
         _match = Match(tree)
-        if not Search._match_recursive(_match, self.evaluator_sequence):
+        if not Search._match_recursive(_match, self._steps(tree), 0):
             return []
         matches = _match.next_matches
         return matches if len(self.evaluator_sequence) > 0 else [m.node for m in matches]
     @staticmethod
-    def _match_recursive(match : Match, evaluator_sequence : List[NodePathEvaluator]) -> bool:
-        if not evaluator_sequence:
+    def _match_recursive(match : Match, steps : List[Step], i : int) -> bool:
+        if i == len(steps):
             return True
-        if not evaluator_sequence[0].evaluate(match.node):
-            return False
+        node_lister, predicate = steps[i]
         match.next_matches = []
-        for node in evaluator_sequence[0].matching_nodes:
+        for node in node_lister(match.node):
+            if not predicate(node):
+                continue
             child = Match(node)
-            if Search._match_recursive(child, evaluator_sequence[1:]):
+            if Search._match_recursive(child, steps, i + 1):
                 match.next_matches.append(child)
         return bool(match.next_matches)
 
+    def exists(self, tree : Tree) -> bool:
+        # whether match(tree) would be non-empty, stopping at the first complete match
+        steps = self._steps(tree)
+        return bool(steps) and Search._exists_from(tree, steps, 0)
+    @staticmethod
+    def _exists_from(node : Tree, steps : List[Step], i : int) -> bool:
+        if i == len(steps):
+            return True
+        node_lister, predicate = steps[i]
+        for n in node_lister(node):
+            if predicate(n) and Search._exists_from(n, steps, i + 1):
+                return True
+        return False
+
+    def count(self, tree : Tree) -> int:
+        # len(match(tree)), without building the Match objects
+        steps = self._steps(tree)
+        if not steps:
+            return 0
+        node_lister, predicate = steps[0]
+        return sum(1 for n in node_lister(tree) if predicate(n) and Search._exists_from(n, steps, 1))
+
+    def iter_matches(self, tree : Tree, level : int = None) -> Generator[List[Tree], None, None]:
+        # yields every complete match path, one node per step, depth first
+        # level: only the paths down to that match level, each once, like the Match objects of that level
+        if level is not None:
+            self._check_level(level)
+        steps = self._steps(tree)
+        if steps:
+            yield from Search._iter_from(tree, steps, 0, [], len(steps) - 1 if level is None else level)
+    def _check_level(self, level : int):
+        if not 0 <= level < len(self.evaluator_sequence):
+            raise Exception('Match level %d out of range for %s' % (level, str(self.evaluator_sequence)))
+    @staticmethod
+    def _iter_from(node : Tree, steps : List[Step], i : int, path : List[Tree], last : int) \
+            -> Generator[List[Tree], None, None]:
+        node_lister, predicate = steps[i]
+        for n in node_lister(node):
+            if not predicate(n):
+                continue
+            path.append(n)
+            if i < last:
+                yield from Search._iter_from(n, steps, i + 1, path, last)
+            elif Search._exists_from(n, steps, i + 1):
+                yield list(path)
+            path.pop()
+
+    def group_counts(self, tree : Tree, key : GroupKey, second_key : GroupKey = None,
+                     counts : Counter = None) -> Counter:
+        # Counts the matches of tree by the value of key, a (match level, field path) pair, e.g. (1, 'lemma'),
+        # adding to counts if given. Every Match of that level counts once, as in
+        # Match.get_matches(self.match(tree), level). With a second key, counts (value, second value) pairs
+        # for every distinct match path down to the deeper of the two levels.
+        counts = Counter() if counts is None else counts
+        keys = [key] if second_key is None else [key, second_key]
+        for level, _ in keys:
+            self._check_level(level)
+        last = max(level for level, _ in keys)
+        if second_key is None:
+            level, path = key
+            counts.update(group_value(p[level], path) for p in self.iter_matches(tree, last))
+        else:
+            (level, path), (second_level, second_path) = keys
+            counts.update((group_value(p[level], path), group_value(p[second_level], second_path))
+                          for p in self.iter_matches(tree, last))
+        return counts
+
+    def aggregate(self, trees : Iterable[Tree], key : GroupKey, second_key : GroupKey = None) -> Counter:
+        # group_counts summed over trees (or sentences, whose trees are searched if they have one),
+        # keeping only the counts. counts.most_common(k) gives the top k; Counter.update merges partial counts.
+        counts = Counter()
+        for tree in trees:
+            tree = getattr(tree, 'root', tree)
+            if tree is not None:
+                self.group_counts(tree, key, second_key, counts)
+        return counts
+
+
+def group_value(node : Tree, path : str) -> str|None:
+    # the value grouped on by Search.group_counts; several values are joined in sorted order
+    v = node.data(path)
+    if v is None or isinstance(v, str):
+        return v
+    if isinstance(v, Tree): # a whole dict field, with keys and values sorted so every process gives the same string
+        return format_dict_field(path, {k: v.data(k) for k in sorted(v.keys())})
+    return ','.join(sorted(v))
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class QueryCache:
+    # process-wide LRU cache of Search objects, keyed by expression string
+    def __init__(self, maxsize : int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries : OrderedDict[str, Search] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, expr : str) -> Search:
+        with self._lock:
+            search = self._entries.get(expr)
+            if search is not None:
+                self._entries.move_to_end(expr)
+                self.hits += 1
+                return search
+            self.misses += 1
+        from conllu_path_shartular.expr_parser import parse_evaluator # imports lark, so only once needed
+        search = Search(parse_evaluator(expr))
+        search.expr_src = expr
+        with self._lock:
+            if self.maxsize > 0:
+                self._entries[expr] = search
+                self._evict()
+        return search
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def resize(self, maxsize : int):
+        # maxsize 0 disables caching
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
 
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
 
+query_cache = QueryCache()
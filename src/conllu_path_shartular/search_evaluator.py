@@ -1,20 +1,41 @@
 from __future__ import annotations
 
 from enum import Enum
-from typing import Iterable, Set, List
+from typing import Iterable, Set, List, Dict, Callable, Tuple
 
-from conllu_path_shartular import Tree
+from conllu_path_shartular.tree import Tree, DictNode, LazyField
 
+Predicate = Callable[[Tree], bool]
+NodeLister = Callable[[Tree], List[Tree]]
+Step = Tuple[NodeLister, Predicate]
 
 class Evaluator:
     def evaluate(self, node : Tree) -> bool:
         pass
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        # key_index_dict: layout of the FixedKeysNodes that will be tested, so that
+        # field lookups can be resolved to list indices now rather than per node
+        return self.evaluate
 
 class ConstantEvaluator(Evaluator):
     def __init__(self, value : bool):
         self._value = value
     def evaluate(self, node : Tree) -> bool:
         return self._value
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        value = self._value
+        return lambda node: value
+    def __str__(self):
+        return '*' if self._value else '!*'
+    def __repr__(self):
+        return self.__str__()
+
+def intersects(values : Set[str], actual_values) -> bool:
+    if isinstance(actual_values, str):
+        return actual_values in values
+    if isinstance(actual_values, Iterable):
+        return not values.isdisjoint(actual_values)
+    return False # unknown type of value or None
 
 class ValueComparer(Evaluator):
     def __init__(self, operator : str, key : str, values : Iterable[str]):
@@ -31,6 +52,56 @@ class ValueComparer(Evaluator):
             actual_values = set()
         return bool(self.values.intersection(actual_values))
 
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        key = list(self.key)
+        values = frozenset(self.values)
+        if not key_index_dict or key[0] not in key_index_dict:
+            return lambda node: intersects(values, node.data(key))
+        kid = key_index_dict
+        i = kid[key[0]]
+        if len(key) == 1:
+            if len(values) == 1:
+                value, = values
+                def predicate(node : Tree) -> bool:
+                    try:
+                        v = node._dlist[i] if node.key_index_dict is kid else node.data(key)
+                    except AttributeError: # not a FixedKeysNode
+                        v = node.data(key)
+                    if v.__class__ is str:
+                        return v == value
+                    return v is not None and intersects(values, node.data(key))
+            else:
+                def predicate(node : Tree) -> bool:
+                    try:
+                        v = node._dlist[i] if node.key_index_dict is kid else node.data(key)
+                    except AttributeError:
+                        v = node.data(key)
+                    if v.__class__ is str:
+                        return v in values
+                    return v is not None and intersects(values, node.data(key))
+            return predicate
+        rest = key[1:]
+        sub_key = rest[0] if len(rest) == 1 else None
+        def predicate(node : Tree) -> bool:
+            try:
+                if node.key_index_dict is not kid:
+                    return intersects(values, node.data(key))
+                d = node._dlist[i]
+                if d.__class__ is LazyField:
+                    d = node._value(i)
+            except AttributeError:
+                return intersects(values, node.data(key))
+            if d.__class__ is DictNode and sub_key is not None:
+                v = d._ddict.get(sub_key)
+            elif isinstance(d, Tree):
+                v = d.data(rest)
+            else:
+                return False
+            if v.__class__ is set:
+                return not values.isdisjoint(v)
+            return intersects(values, v)
+        return predicate
+
     def __str__(self):
         return '.'.join(self.key) + self.operator + ','.join(self.values)
     def __repr__(self):
@@ -41,53 +112,78 @@ class Operator(Enum):
     OR = '|'
     NOT = '!'
 
-_op_dict = {
-    Operator.AND: lambda a,b : a and b,
-    Operator.OR: lambda a,b: a or b,
-    Operator.NOT: lambda a,b : not a
-}
-
 class Operation(Evaluator):
     def __init__(self, operator: Operator, left: Evaluator, right: Evaluator = None):
         self.operator = operator
         self.left = left
         self.right = right
     def evaluate(self, node : Tree) -> bool:
-        left_val = self.left.evaluate(node)
-        right_val = self.right.evaluate(node) if self.right else None
-        return _op_dict[self.operator](left_val, right_val)
+        # short-circuit: the right operand is only evaluated if it can change the result
+        if self.operator == Operator.AND:
+            return self.left.evaluate(node) and self.right.evaluate(node)
+        if self.operator == Operator.OR:
+            return self.left.evaluate(node) or self.right.evaluate(node)
+        if self.operator == Operator.NOT:
+            return not self.left.evaluate(node)
+        raise Exception("Unknown operator " + str(self.operator))
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        left = self.left.compile(key_index_dict)
+        if self.operator == Operator.NOT:
+            return lambda node: not left(node)
+        right = self.right.compile(key_index_dict)
+        if self.operator == Operator.AND:
+            return lambda node: left(node) and right(node)
+        if self.operator == Operator.OR:
+            return lambda node: left(node) or right(node)
+        raise Exception("Unknown operator " + str(self.operator))
     def __str__(self):
         return str(self.operator.value) + '(' + self.left.__str__() + (' ' + self.right.__str__() if self.right else '') + ')'
     def __repr__(self):
         return str(self)
 
 
+_path_dict : Dict[str, NodeLister] = {
+    '../': lambda node: [node.parent] if node.parent else [], # parent
+    '/': lambda node: node.children(), # children
+    '//': lambda node: node.descendants(), # all descendants
+    './': lambda node: [node] + node.children(), # children plus self
+    './/': lambda node: node.descendants(True), # all descendants plus self
+    '.': lambda node: [node], # current head_node
+    '<': lambda node: node.before(),
+    '>': lambda node: node.after(),
+}
+
 class NodePathEvaluator(Evaluator):
     def __init__(self, path_type : str, evaluator : Evaluator):
         self.path_type = path_type
         self.evaluator = evaluator
-        self.matching_nodes = []
-    def evaluate(self, node : Tree) -> bool:
-        if self.path_type == '../': # parent
-            node_list = [node.parent] if node.parent else []
-        elif self.path_type == '/': # children
-            node_list = node.children()
-        elif self.path_type == '//': # all descendants
-            node_list = [c for c in node.traverse() if c is not node]
-        elif self.path_type == './': # children plus self
-            node_list = [node] + node.children()
-        elif self.path_type == './/': # all descendants plus self
-            node_list = list(node.traverse())
-        elif self.path_type == '.': # current head_node
-            node_list = [node]
-        elif self.path_type == '<':
-            node_list = node.before() #[child for child in node.children() if before(child, node)]
-        elif self.path_type == '>':
-            node_list = node.after() #[child for child in node.children() if not before(child, node)]
-        else:
+    def _node_lister(self) -> NodeLister:
+        if self.path_type not in _path_dict:
             raise Exception("Unknown path " + str(self.path_type))
-        self.matching_nodes = [n for n in node_list if self.evaluator.evaluate(n)]
-        return bool(self.matching_nodes)
+        return _path_dict[self.path_type]
+    def matches(self, node : Tree) -> List[Tree]:
+        # the nodes along the path that satisfy the evaluator; nothing is stored on the evaluator,
+        # so one instance can be shared between threads and nested queries
+        return [n for n in self._node_lister()(node) if self.evaluator.evaluate(n)]
+    def evaluate(self, node : Tree) -> bool:
+        return any(self.evaluator.evaluate(n) for n in self._node_lister()(node))
+
+    def compile_step(self, key_index_dict : Dict[str, int] = None) -> Tuple[NodeLister, Predicate]:
+        # the nodes along the path, and the test they must pass
+        return self._node_lister(), self.evaluator.compile(key_index_dict)
+    def compile_matcher(self, key_index_dict : Dict[str, int] = None) -> NodeLister:
+        # returns a function giving the nodes along the path that satisfy the evaluator
+        node_lister, predicate = self.compile_step(key_index_dict)
+        return lambda node: [n for n in node_lister(node) if predicate(n)]
+    def compile(self, key_index_dict : Dict[str, int] = None) -> Predicate:
+        node_lister = self._node_lister()
+        predicate = self.evaluator.compile(key_index_dict)
+        def path_predicate(node : Tree) -> bool:
+            for n in node_lister(node):
+                if predicate(n):
+                    return True
+            return False
+        return path_predicate
 
     def __str__(self):
         return self.path_type + '[' + self.evaluator.__str__() + ']'
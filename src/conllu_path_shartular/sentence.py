@@ -1,10 +1,15 @@
 from __future__ import annotations
 
 from collections import defaultdict
-from typing import List
+from typing import List, TYPE_CHECKING
 
-from conllu_path_shartular.tree import Tree
-from conllu_path_shartular.search import Search, Match
+from conllu_path_shartular.tree import Tree, TreeOrder
+
+if TYPE_CHECKING: # imported when searching, so that sentences can be read without the query machinery
+    from conllu_path_shartular.search import Search, Match
+
+ROOT_HEAD = -1 # in the heads argument of Sentence, the root
+NO_HEAD = -2 # a node outside the tree, such as a multiword token
 
 class Sentence:
     def __init__(self, node_sequence : List[Tree], **kwargs):
@@ -12,9 +17,15 @@ class Sentence:
         self.sent_id = kwargs.get('sent_id')
         self.text = kwargs.get('text')
         self.meta = kwargs.get('meta')
-        self._id_dict = {n.sdata('id'):n for n in self.sequence}
+        ids = kwargs.get('ids') # the id of each node, if already known
+        self._id_dict = dict(zip(ids, node_sequence)) if ids is not None else {n.sdata('id'):n for n in self.sequence}
         self.root = None
         self.sanity_comment = ''
+        heads = kwargs.get('heads') # head positions of a sentence that passed sanity_check before
+        if heads is not None:
+            self._is_good = True
+            self.build_tree_from_heads(heads)
+            return
         self._is_good = self.sanity_check()
         if self._is_good:
             self.build_tree()
@@ -62,6 +73,23 @@ class Sentence:
                 children_dict[head].append(node)
         for head_id, children in children_dict.items():
             self._id_dict[head_id].set_children(children)
+        if self.root is not None:
+            TreeOrder(self.root)
+
+    def build_tree_from_heads(self, heads : List[int]):
+        # heads: the position in sequence of each node's head, or ROOT_HEAD or NO_HEAD
+        children = [[] for _ in self.sequence]
+        for i, head in enumerate(heads):
+            if head >= 0:
+                children[head].append(i)
+            elif head == ROOT_HEAD:
+                self.root = self.sequence[i]
+        for i, child_positions in enumerate(children):
+            if child_positions:
+                before_count = sum(1 for j in child_positions if j < i)
+                self.sequence[i]._set_ordered_children([self.sequence[j] for j in child_positions], before_count)
+        if self.root is not None:
+            TreeOrder(self.root)
 
     def __bool__(self):
         return self._is_good
@@ -70,7 +98,8 @@ class Sentence:
 
     def search(self, src: str|Search) -> List[Tree]|List[Match]:
         if isinstance(src, str):
-            src = Search(src)
+            from conllu_path_shartular.search import query_cache
+            src = query_cache.get(src)
         return src.match(self.root)
 
     def __str__(self):
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, List, Tuple
+
+from conllu_path_shartular.compressed import open_conllu
+from conllu_path_shartular.conllu import iter_conllu_blocks, block_sent_id, file_signature
+
+SENTENCE_INDEX_MAGIC = b'CPSIDX1\n'
+SENTENCE_INDEX_EXTENSION = '.sidx'
+
+class SentenceIndex:
+    # byte offset and length of every sentence of a conllu file, by position and by sent_id;
+    # offsets in a compressed file are positions in its decompressed text
+    def __init__(self, source_path : str, source_signature : Tuple[int, int],
+                 sent_ids : List[str|None], offsets : array, lengths : array):
+        self.source_path = source_path
+        self.source_signature = tuple(source_signature)
+        self.sent_ids = sent_ids
+        self.offsets = offsets
+        self.lengths = lengths
+        self._positions : Dict[str, int] = {}
+        for i, sent_id in enumerate(sent_ids):
+            if sent_id is not None and sent_id not in self._positions:
+                self._positions[sent_id] = i
+
+    @staticmethod
+    def build(conllu_path : str) -> SentenceIndex:
+        signature = file_signature(conllu_path)
+        sent_ids, offsets, lengths = [], array('q'), array('q')
+        with open_conllu(conllu_path) as file:
+            for offset, block in iter_conllu_blocks(file):
+                sent_ids.append(block_sent_id(block))
+                offsets.append(offset)
+                lengths.append(len(block))
+        return SentenceIndex(os.path.abspath(conllu_path), signature, sent_ids, offsets, lengths)
+
+    def save(self, index_path : str):
+        header = json.dumps({'source_path': self.source_path, 'source_signature': list(self.source_signature),
+                             'sent_ids': self.sent_ids}).encode('utf-8')
+        offsets, lengths = array('q', self.offsets), array('q', self.lengths)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            lengths.byteswap()
+        with open(index_path, 'wb') as file:
+            file.write(SENTENCE_INDEX_MAGIC)
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            offsets.tofile(file)
+            lengths.tofile(file)
+
+    @staticmethod
+    def load(index_path : str) -> SentenceIndex:
+        with open(index_path, 'rb') as file:
+            if file.read(len(SENTENCE_INDEX_MAGIC)) != SENTENCE_INDEX_MAGIC:
+                raise Exception('Not a sentence index file: ' + index_path)
+            header_len, = struct.unpack('<Q', file.read(8))
+            header = json.loads(file.read(header_len).decode('utf-8'))
+            count = len(header['sent_ids'])
+            offsets, lengths = array('q'), array('q')
+            offsets.fromfile(file, count)
+            lengths.fromfile(file, count)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            lengths.byteswap()
+        return SentenceIndex(header['source_path'], header['source_signature'], header['sent_ids'],
+                             offsets, lengths)
+
+    def is_current(self) -> bool:
+        return os.path.exists(self.source_path) and file_signature(self.source_path) == self.source_signature
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def position(self, sent_id : str) -> int|None:
+        return self._positions.get(sent_id)
+
+    def span(self, i : int) -> Tuple[int, int]:
+        return self.offsets[i], self.lengths[i]
+
+def load_sentence_index(conllu_path : str, index_path : str = None, rebuild : bool = True) -> SentenceIndex|None:
+    # loads the sidecar index of conllu_path, (re)building and saving it if missing or out of date
+    index_path = index_path if index_path else conllu_path + SENTENCE_INDEX_EXTENSION
+    if os.path.exists(index_path):
+        index = SentenceIndex.load(index_path)
+        if index.is_current():
+            return index
+    if not rebuild:
+        return None
+    index = SentenceIndex.build(conllu_path)
+    index.save(index_path)
+    return index
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 import abc
-from typing import Dict, List, Set, Generator
+from typing import Dict, List, Set, Generator, Callable
 
 
 class Tree(abc.ABC):
+    __slots__ = () # lets subclasses such as CompactNode do without a per-instance __dict__
     PATH_SEPARATOR = '.'
+    _order : TreeOrder = None # set by TreeOrder once the whole tree is built
+    _order_pos : int = None
     def __init__(self, children : List['Tree'] = None, parent : 'Tree' = None):
         self._children = []
         self._before = []
@@ -14,6 +17,8 @@ class Tree(abc.ABC):
         if children:
             self.set_children(children)
     def set_children(self, children : List['Tree']):
+        if self._order is not None: # the tree changed shape
+            self._order.valid = False
         self._children = children
         self._children.sort(key=lambda n : int(n.sdata('id')))
         for child in self._children:
@@ -22,6 +27,15 @@ class Tree(abc.ABC):
         if id is not None:
             self._before = [n for n in children if n.id_nr() < id]
             self._after = [n for n in children if n.id_nr() > id]
+    def _set_ordered_children(self, children : List['Tree'], before_count : int):
+        # like set_children, for children already sorted by id, the first before_count of them before this node
+        if self._order is not None:
+            self._order.valid = False
+        self._children = children
+        for child in children:
+            child.parent = self
+        self._before = children[:before_count]
+        self._after = children[before_count:]
     def children(self) -> List[Tree]:
         return list(self._children)
     def before(self) -> List[Tree]:
@@ -34,6 +48,10 @@ class Tree(abc.ABC):
     def id_nr(self) -> int:
         return int(self.id()) if str.isnumeric(self.id()) else None
     def traverse(self) -> Generator[Tree, None, None]:
+        order = self._order
+        if order is not None and order.valid:
+            yield from order.nodes[order.start[self._order_pos]:order.end[self._order_pos]]
+            return
         for child in self.before():
             for node in child.traverse():
                 yield node
@@ -41,6 +59,31 @@ class Tree(abc.ABC):
         for child in self.after():
             for node in child.traverse():
                 yield node
+    def descendants(self, include_self : bool = False) -> List[Tree]:
+        # all nodes under this one, in traverse order
+        order = self._order
+        if order is not None and order.valid:
+            pos = self._order_pos
+            if include_self:
+                return order.nodes[order.start[pos]:order.end[pos]]
+            return order.nodes[order.start[pos]:pos] + order.nodes[pos + 1:order.end[pos]]
+        return [n for n in self.traverse() if include_self or n is not self]
+    def is_ancestor_of(self, node : Tree) -> bool:
+        order = self._order
+        if order is not None and order.valid and node._order is order:
+            pos = self._order_pos
+            return node._order_pos != pos and order.start[pos] <= node._order_pos < order.end[pos]
+        parent = node.parent
+        while parent is not None:
+            if parent is self:
+                return True
+            parent = parent.parent
+        return False
+    def depth(self) -> int:
+        order = self._order
+        if order is not None and order.valid:
+            return order.depth[self._order_pos]
+        return 0 if self.parent is None else self.parent.depth() + 1
 
     @abc.abstractmethod
     def data(self, path: str | List[str] = None) -> Tree | Set | str | None:
@@ -59,12 +102,40 @@ class Tree(abc.ABC):
     @abc.abstractmethod
     def to_dict(self) -> Dict[str, Tree | Set | str | None]:
         pass
+    def raw_line(self) -> str|None:
+        # the node's conllu line, if it can be written out as is
+        return None
 
     def __str__(self):
         return "%s:%s" % (self.id(), self.sdata('form'))
     def __repr__(self):
         return str(self)
 
+class TreeOrder:
+    # Traverse order of a whole tree, in which every subtree is the contiguous slice
+    # nodes[start[pos]:end[pos]] around the node's own position pos.
+    def __init__(self, root : Tree):
+        self.nodes : List[Tree] = []
+        self.start : List[int] = []
+        self.end : List[int] = []
+        self.depth : List[int] = []
+        self.valid = True
+        self._visit(root, 0)
+    def _visit(self, node : Tree, depth : int):
+        start = len(self.nodes)
+        for child in node.before():
+            self._visit(child, depth + 1)
+        pos = len(self.nodes)
+        self.nodes.append(node)
+        self.start.append(start)
+        self.end.append(None)
+        self.depth.append(depth)
+        node._order = self
+        node._order_pos = pos
+        for child in node.after():
+            self._visit(child, depth + 1)
+        self.end[pos] = len(self.nodes)
+
 class DictNode(Tree):
     def __init__(self, d : Dict, children : List[Tree] = None, parent : Tree = None):
         super().__init__(children, parent)
@@ -100,29 +171,66 @@ class DictNode(Tree):
             return True
         return False
 
+class LazyField:
+    # raw value of a field, parsed into a Tree the first time the field is read
+    __slots__ = ('raw', 'parser')
+    def __init__(self, raw : str, parser : Callable[[str], Tree]):
+        self.raw = raw
+        self.parser = parser
+    def parse(self) -> Tree:
+        return self.parser(self.raw)
+    def __repr__(self):
+        return 'LazyField(%s)' % repr(self.raw)
+
 class FixedKeysNode(Tree):
-    def __init__(self, l : List[DictNode | Set | str | None],
+    def __init__(self, l : List[DictNode | LazyField | Set | str | None],
                  key_index_dict : Dict[str, int],
-                 children : List['Tree'] = None, parent : 'Tree' = None):
+                 children : List['Tree'] = None, parent : 'Tree' = None, raw_line : str = None):
         super().__init__(children, parent)
         self._dlist = l
+        self._raw_line = raw_line # source line
+        self._source : List | None = None # the fields as read, kept from the first parse or assignment
         self.key_index_dict = key_index_dict
         if min(self.key_index_dict.values()) < 0:
             raise Exception('Negative index in key_index_dict')
         if max(self.key_index_dict.values()) > len(self._dlist) - 1:
             self._dlist.extend([None]*(max(self.key_index_dict.values()) - (len(self._dlist) - 1)))
+    def _value(self, i : int) -> Tree | Set | str | None:
+        v = self._dlist[i]
+        if v.__class__ is LazyField:
+            self._keep_source()
+            v = self._dlist[i] = v.parse()
+        return v
+    def _keep_source(self):
+        if self._source is None and self._raw_line is not None:
+            self._source = list(self._dlist)
     def keys(self) -> List[str]:
         return list(self.key_index_dict.keys())
+    def raw_line(self) -> str|None:
+        # the source line, as long as every field still has the value read from it; parsed
+        # fields can be changed in place, so they are compared with a fresh parse
+        if self._source is not None and self._raw_line is not None:
+            for source, v in zip(self._source, self._dlist):
+                if source is v:
+                    continue
+                if source.__class__ is LazyField:
+                    if not isinstance(v, Tree) or v.to_dict() != source.parse().to_dict():
+                        return None
+                elif source != v:
+                    return None
+        return self._raw_line
     def to_dict(self) -> Dict:
-        return {k: (self._dlist[i].to_dict() if isinstance(self._dlist[i], Tree) else self._dlist[i])
-                for k, i in self.key_index_dict.items()}
+        values = {k: self._value(i) for k, i in self.key_index_dict.items()}
+        return {k: (v.to_dict() if isinstance(v, Tree) else v) for k, v in values.items()}
     def data(self, path: str | List[str] = None) -> Tree | Set | str | None:
         if isinstance(path, str):
             path = path.split(Tree.PATH_SEPARATOR)
         if not path:
             return self
-        v = self._dlist[self.key_index_dict[path[0]]] if path[0] in self.key_index_dict else None
+        v = self._value(self.key_index_dict[path[0]]) if path[0] in self.key_index_dict else None
         if v is None: return None
+        if v.__class__ is str: # most fields; skips the slower abc isinstance check
+            return v if len(path) == 1 else None
         if isinstance(v, Tree):
             return v.data(path[1:])
         if len(path) == 1:
@@ -134,6 +242,7 @@ class FixedKeysNode(Tree):
             path = path.split(Tree.PATH_SEPARATOR)
         if len(path) == 1:
             if path[0] in self.key_index_dict:
+                self._keep_source()
                 self._dlist[self.key_index_dict[path[0]]] = value
                 return True
             return False
@@ -0,0 +1,32 @@
+import random
+
+import pytest
+
+UPOS = ('NOUN', 'VERB', 'ADJ', 'DET', 'PRON', 'AUX')
+DEPREL = ('nsubj', 'obj', 'obl', 'amod', 'det', 'aux')
+FEATURES = {'Case': ('Nom', 'Acc', 'Gen', 'Nom,Acc'), 'Number': ('Sing', 'Plur'), 'PronType': ('Int', 'Rel', 'Int,Rel')}
+
+def random_sentence(i, rng):
+    # a random tree of 1 to 8 tokens, heads coming before or after their dependents
+    length = rng.randint(1, 8)
+    order = rng.sample(range(1, length + 1), length)
+    heads = {order[0]: 0}
+    for k, n in enumerate(order[1:], 1):
+        heads[n] = rng.choice(order[:k])
+    lines = ['# sent_id = s%d' % i, '# text = sentence %d' % i]
+    for n in range(1, length + 1):
+        head = heads[n]
+        feats = '|'.join('%s=%s' % (key, rng.choice(values)) for key, values in FEATURES.items()
+                         if rng.random() < 0.4) or '_'
+        misc = 'SpaceAfter=No' if rng.random() < 0.2 else '_'
+        lines.append('\t'.join([str(n), 'w%d' % rng.randrange(20), 'l%d' % rng.randrange(5), rng.choice(UPOS), '_',
+                                feats, str(head), 'root' if head == 0 else rng.choice(DEPREL), '_', misc]))
+    return '\n'.join(lines) + '\n\n'
+
+@pytest.fixture
+def treebank(tmp_path):
+    # a conllu file of 300 random sentences, the same every time
+    rng = random.Random(0)
+    path = tmp_path / 'treebank.conllu'
+    path.write_bytes(''.join(random_sentence(i, rng) for i in range(300)).encode('utf-8'))
+    return str(path)
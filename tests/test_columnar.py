@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+from conllu_path_shartular.columnar import ColumnarCorpus
+from conllu_path_shartular.conllu import iter_sentences_from_conllu
+from conllu_path_shartular.search import Search
+
+QUERIES = [
+    './/[upos=VERB]',
+    './/[feats.Case=Acc]',
+    './/[feats.PronType=Int,Rel & feats.Number=Plur]',
+    './/[feats.Case=Gen | upos=AUX]',
+    './/[!feats.Case=Acc & !upos=NOUN]',
+    './/[upos=VERB & !/[deprel=nsubj]]',
+    './/[upos=VERB]/[deprel=obj]//[feats.Number=Sing]',
+    './/[upos=VERB & /[upos=PRON & /[*]]]',
+    '//[deprel=amod]',
+    '/[*]',
+    './/[deprel=amod]../[upos=NOUN]',
+    './/[upos=DET]../[feats.Case=Nom]../[deprel=root]',
+    './/[upos=NOUN]./[feats.Number=Plur]',
+    './/[upos=NOUN].[feats.Number=Plur]',
+    './/[upos=VERB]<[deprel=det]',
+    './/[upos=VERB]>[deprel=det]',
+    './/[upos=NOUN]//[lemma=l1 & misc.SpaceAfter=No]',
+    './/[feats=Acc]',
+    './/[upos=VERB]/[*]/[*]',
+]
+
+@pytest.fixture
+def sentences(treebank):
+    return list(iter_sentences_from_conllu(treebank, use_cache=False))
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_counts_agree_with_tree_search(sentences, query):
+    corpus = ColumnarCorpus(sentences)
+    search = Search(query)
+    expected = [len(search.match(sentence.root)) for sentence in sentences]
+    assert list(corpus.sentence_counts(search)) == expected
+    assert corpus.count(search) == sum(expected)
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_search_agrees_with_tree_search(sentences, query):
+    corpus = ColumnarCorpus(sentences)
+    search = Search(query)
+    expected = [(sentence.sent_id, len(matches)) for sentence in sentences
+                for matches in [search.match(sentence.root)] if matches]
+    assert [(sent_id, len(matches)) for sent_id, matches in corpus.search(search)] == expected
@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from conftest import random_sentence
+from conllu_path_shartular.conllu import iter_sentences_from_conllu, sentence_to_conllu
+from conllu_path_shartular.corpus import Corpus
+from conllu_path_shartular.sentence_index import SentenceIndex
+
+@pytest.fixture
+def paths(tmp_path):
+    # three files of 20, 0 and 30 sentences
+    rng = random.Random(1)
+    paths = []
+    for n, count in enumerate([20, 0, 30]):
+        path = tmp_path / ('part%d.conllu' % n)
+        path.write_bytes(''.join(random_sentence(100 * n + i, rng) for i in range(count)).encode('utf-8'))
+        paths.append(str(path))
+    return paths
+
+def texts(sentences):
+    return [sentence_to_conllu(sentence) for sentence in sentences]
+
+def test_positions_and_slices(paths):
+    expected = texts(s for path in paths for s in iter_sentences_from_conllu(path, use_cache=False))
+    corpus = Corpus(paths)
+    assert len(corpus) == 50
+    assert texts(corpus[i] for i in range(50)) == expected
+    assert texts([corpus[-1], corpus[-50]]) == [expected[-1], expected[0]]
+    assert texts(corpus[15:25]) == expected[15:25]
+    assert texts(corpus[::-7]) == expected[::-7]
+    with pytest.raises(IndexError):
+        corpus[50]
+    with pytest.raises(IndexError):
+        corpus[-51]
+    corpus.close()
+
+def test_files_are_checked_once_per_access(paths, monkeypatch):
+    corpus = Corpus(paths)
+    corpus[0]
+    checks = []
+    is_current = SentenceIndex.is_current
+    monkeypatch.setattr(SentenceIndex, 'is_current', lambda index: checks.append(index) or is_current(index))
+    corpus[30]
+    assert len(checks) == 1 # only the file read
+    checks.clear()
+    corpus[10:40]
+    assert len(checks) == len(paths) # every file once
+    corpus.close()
+
+def test_changed_file_is_counted_again(paths):
+    corpus = Corpus(paths)
+    assert corpus[20].sent_id == 's200'
+    with open(paths[0], 'a', encoding='utf-8') as file:
+        file.write(random_sentence(99, random.Random(2)))
+    assert corpus[20].sent_id == 's200' # the first file is not checked
+    assert corpus[0].sent_id == 's0' # and now it is, and counted again
+    assert corpus[20].sent_id == 's99'
+    assert corpus[21].sent_id == 's200'
+    with open(paths[2], 'a', encoding='utf-8') as file:
+        file.write(random_sentence(399, random.Random(2)))
+    assert len(corpus) == 52
+    assert [s.sent_id for s in corpus[-2:]] == ['s229', 's399']
+    corpus.close()
+
+def test_zstd_files_cannot_be_read_at_random(paths):
+    zstandard = pytest.importorskip('zstandard')
+    with open(paths[2], 'rb') as file:
+        data = file.read()
+    with open(paths[2] + '.zst', 'wb') as file:
+        file.write(zstandard.ZstdCompressor().compress(data))
+    corpus = Corpus([paths[0], paths[2] + '.zst'])
+    assert len(corpus) == 50
+    assert corpus[19].sent_id == 's19'
+    assert corpus.get('s301') is None
+    with pytest.raises(ValueError, match='zstd'):
+        corpus[20]
+    with pytest.raises(ValueError, match='zstd'):
+        corpus.get('s200')
+    corpus.close()
@@ -0,0 +1,42 @@
+import pytest
+
+from conllu_path_shartular.conllu import iter_sentences_from_conllu
+from conllu_path_shartular.inverted_index import build_inverted_index, required_terms
+from conllu_path_shartular.search import Search
+
+QUERIES = [
+    './/[upos=VERB]',
+    './/[feats.Case=Acc]',
+    './/[feats.PronType=Int,Rel & feats.Number=Plur]',
+    './/[feats.Case=Gen | upos=AUX]',
+    './/[upos=NOUN | feats.Case=Nom]/[deprel=det | deprel=amod]',
+    './/[!upos=NOUN & deprel=obj]',
+    './/[!feats.Case=Acc]',
+    './/[upos=VERB & !/[deprel=nsubj]]',
+    './/[upos=VERB]/[deprel=obj]//[feats.Number=Sing]',
+    './/[upos=VERB & /[upos=PRON & /[*]]]',
+    './/[/[upos=PRON & /[deprel=det | deprel=amod]]]',
+    '//[deprel=amod]',
+    './/[deprel=amod]../[upos=NOUN]',
+    './/[upos=DET]../[feats.Case=Nom]../[deprel=root]',
+    './/[lemma=l1 & misc.SpaceAfter=No]',
+    './/[upos=NOUN & (lemma=l2 | !feats.Number=Sing)]',
+    './/[*]/[lemma=l0]',
+]
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_search_finds_every_match(treebank, tmp_path, query):
+    index = build_inverted_index(treebank, str(tmp_path / 'treebank.tidx'))
+    search = Search(query)
+    expected = [(sentence.sent_id, len(matches)) for sentence in iter_sentences_from_conllu(treebank, use_cache=False)
+                for matches in [search.match(sentence.root)] if matches]
+    assert expected # every query matches somewhere, so dropping a sentence would show
+    assert [(sent_id, len(matches)) for sent_id, matches in index.search(search)] == expected
+
+def test_required_terms():
+    fields = ['upos', 'feats']
+    assert required_terms(Search('.//[upos=VERB & lemma=go]').evaluator_sequence, fields) == [{'upos=VERB'}]
+    assert required_terms(Search('.//[upos=VERB | feats.Case=Acc,Gen]').evaluator_sequence, fields) == \
+        [{'upos=VERB', 'feats.Case=Acc', 'feats.Case=Gen'}]
+    assert required_terms(Search('.//[upos=VERB | lemma=go]').evaluator_sequence, fields) == []
+    assert required_terms(Search('.//[!upos=VERB]').evaluator_sequence, fields) == []
@@ -0,0 +1,56 @@
+from conllu_path_shartular.conllu import iter_sentences_from_conllu, filter_conllu, sentence_to_conllu
+from conllu_path_shartular.parsed_cache import build_parsed_cache, load_parsed_cache, iter_cached_sentences, \
+    PARSED_CACHE_EXTENSION
+
+# lines the writer would not give back if it formatted the fields itself: unsorted keys and values,
+# an empty field and a comment that is neither sent_id nor text
+ODD_SENTENCE = '\n'.join([
+    '# newpar',
+    '# sent_id = odd',
+    '1\tThey\tthey\tPRON\t\tNumber=Plur|Case=Acc,Nom\t2\tnsubj\t_\t_',
+    '2\tread\tread\tVERB\t_\tPronType=Rel,Int\t0\troot\t_\tSpaceAfter=No|Gloss=read',
+]) + '\n\n'
+
+def node_state(sentence):
+    return [(node.raw_line(), node.to_dict(), node.parent.id() if node.parent is not None else None)
+            for node in sentence.sequence]
+
+def test_cache_gives_the_sentences_of_the_text(treebank, tmp_path):
+    with open(treebank, 'a', encoding='utf-8') as file:
+        file.write(ODD_SENTENCE)
+    text = list(iter_sentences_from_conllu(treebank, use_cache=False))
+    cache = build_parsed_cache(treebank)
+    try:
+        cached = list(cache)
+        assert len(cached) == len(text) == 301
+        for sentence, expected in zip(cached, text):
+            assert (sentence.sent_id, sentence.text, sentence.meta) == (expected.sent_id, expected.text, expected.meta)
+            assert node_state(sentence) == node_state(expected)
+            assert sentence_to_conllu(sentence) == sentence_to_conllu(expected)
+    finally:
+        cache.close()
+
+def test_writing_from_the_cache_copies_source_lines(treebank, tmp_path):
+    with open(treebank, 'a', encoding='utf-8') as file:
+        file.write(ODD_SENTENCE)
+    query = './/[feats.Case=Acc | feats.PronType=Rel]' # parses feats, which must still be written as read
+    from_text, from_cache = str(tmp_path / 'text.conllu'), str(tmp_path / 'cache.conllu')
+    filter_conllu(treebank, from_text, query) # no cache yet
+    build_parsed_cache(treebank).close()
+    assert filter_conllu(treebank, from_cache, query) > 0
+    with open(from_text, 'rb') as file:
+        expected = file.read()
+    with open(from_cache, 'rb') as file:
+        assert file.read() == expected
+    with open(treebank, 'rb') as file:
+        source_blocks = set(file.read().split(b'\n\n'))
+    assert ODD_SENTENCE.encode('utf-8').rstrip(b'\n') in expected.split(b'\n\n')
+    assert set(expected.split(b'\n\n')) - {b''} <= source_blocks
+
+def test_cache_of_an_older_format_is_not_read(treebank):
+    with open(treebank + PARSED_CACHE_EXTENSION, 'wb') as file:
+        file.write(b'CPPCCH1\n')
+    assert iter_cached_sentences(treebank) is None
+    cache = load_parsed_cache(treebank) # rebuilt
+    assert len(cache) == 300
+    cache.close()
@@ -0,0 +1,72 @@
+from array import array
+
+import pytest
+
+from conllu_path_shartular.inverted_index import load_inverted_index, build_inverted_index
+from conllu_path_shartular.rewrite import rewrite_conllu
+from conllu_path_shartular.sentence_index import SentenceIndex, load_sentence_index
+
+def token(id, form, upos, feats, head, deprel, misc='_'):
+    return '\t'.join([str(id), form, form.lower(), upos, '_', feats, str(head), deprel, '_', misc])
+
+def sentence(i):
+    # every third sentence has a pronoun under its verb, which the queries below look for
+    lines = ['# sent_id = s%d' % i, '# text = sentence %d' % i]
+    if i % 3 == 0:
+        lines += [token(1, 'Who', 'PRON', 'PronType=Int,Rel', 2, 'nsubj'),
+                  token(2, 'runs', 'VERB', 'Mood=Ind|Tense=Pres', 0, 'root', 'SpaceAfter=No')]
+    else:
+        lines += [token(1, 'Dogs', 'NOUN', 'Number=Plur', 2, 'nsubj'),
+                  token(2, 'bark', 'VERB', '_', 0, 'root')]
+    return '\n'.join(lines) + '\n\n'
+
+@pytest.fixture
+def corpus(tmp_path):
+    path = tmp_path / 'corpus.conllu'
+    path.write_bytes(''.join(sentence(i) for i in range(60)).encode('utf-8'))
+    return str(path)
+
+def blocks(path):
+    with open(path, 'rb') as file:
+        return file.read().split(b'\n\n')
+
+def test_only_changed_lines_are_rewritten(corpus):
+    before = blocks(corpus)
+    assert rewrite_conllu(corpus, './/[feats.PronType=Int]../[upos=VERB]', [(1, 'deprel', 'ROOT')], workers=1) == 20
+    after = blocks(corpus)
+    for i, (old, new) in enumerate(zip(before, after)):
+        if i % 3 or i >= 60:
+            assert old == new
+        else:
+            old_lines, new_lines = old.split(b'\n'), new.split(b'\n')
+            assert new_lines[2] == old_lines[2] # the pronoun, only read by the query
+            assert new_lines[3] == old_lines[3].replace(b'\troot\t', b'\tROOT\t')
+
+def test_assigned_values_are_sorted(corpus):
+    rewrite_conllu(corpus, './/[upos=VERB]', [(0, 'feats.PronType', 'Rel,Int'), (0, 'feats.Aspect', 'Imp')], workers=1)
+    lines = blocks(corpus)[1].split(b'\n')
+    assert lines[3].split(b'\t')[5] == b'Aspect=Imp|PronType=Int,Rel'
+    lines = blocks(corpus)[0].split(b'\n')
+    assert lines[3].split(b'\t')[5] == b'Aspect=Imp|Mood=Ind|PronType=Int,Rel|Tense=Pres'
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_indexes_are_updated(corpus, tmp_path, workers):
+    load_sentence_index(corpus)
+    load_inverted_index(corpus)
+    # changes the length of some sentences, and adds and removes index terms
+    changed = rewrite_conllu(corpus, './/[upos=VERB]/[upos=PRON]',
+                             [(0, 'lemma', 'run-run-run'), (1, 'feats.PronType', None), (1, 'upos', 'X')],
+                             workers=workers, chunk_size=256)
+    assert changed == 20
+    sentence_index = load_sentence_index(corpus, rebuild=False)
+    assert sentence_index is not None # still current for the rewritten file
+    fresh = SentenceIndex.build(corpus)
+    assert sentence_index.sent_ids == fresh.sent_ids
+    assert sentence_index.offsets == fresh.offsets
+    assert sentence_index.lengths == fresh.lengths
+    inverted_index = load_inverted_index(corpus, rebuild=False)
+    assert inverted_index is not None
+    fresh = build_inverted_index(corpus, str(tmp_path / 'fresh.tidx'))
+    assert inverted_index.all_postings() == fresh.all_postings()
+    assert inverted_index.postings('upos=PRON') == array('q')
+    assert len(list(inverted_index.search('.//[lemma=run-run-run]/[upos=X]'))) == 20